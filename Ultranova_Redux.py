@@ -1,25 +1,52 @@
 '''Physics and finance engine'''
-import pandas
+import pandas,time
+from concurrent import futures
 import physical,times,xltable,org,references,rates,retrieval
 
-def setup_references(**refreshes) -> xltable.RawXL:
+def setup_references(sources:dict=None,workers:int=None,**refreshes) -> xltable.RawXL:
     '''Extract times of use, translations library and rates database.
-    Pull from pickle file unless forced refresh or file DNE.'''
+    Pull from saved tables unless forced refresh, file DNE or source has changed.
+    Stale references download in threads and parse in processes, all at once.'''
     refs = {'tou':references.times_and_seasons,
             'translations':references.translations,
-            'rates':references.rates}
+            'rates':references.rates} if sources is None else sources
+    variable_sets = {ref: retrieval.VariableSet(ref,source=refs[ref]) for ref in refs}
+    timings = {ref: {} for ref in refs}
+
+    def check(ref):
+        start = time.perf_counter()
+        stale = variable_sets[ref].stale() or refreshes.get(ref)
+        timings[ref]['check'] = time.perf_counter()-start
+        return stale
+
+    def download(ref):
+        start = time.perf_counter()
+        link = retrieval.fetch(refs[ref])
+        timings[ref]['download'] = time.perf_counter()-start
+        return link
+
+    with futures.ThreadPoolExecutor(len(refs)) as threads:
+        stale = [ref for ref,is_stale in zip(refs,threads.map(check,refs)) if is_stale]
+        if len(stale):
+            with futures.ProcessPoolExecutor(workers) as processes:
+                downloads = {threads.submit(download,ref): ref for ref in stale}
+                parses = {}
+                for downloaded in futures.as_completed(downloads):
+                    ref = downloads[downloaded]
+                    parses[processes.submit(retrieval.build_variables,ref,xltable.RawXL,refs[ref],
+                                            downloaded.result(),variable_sets[ref]._fingerprint)] = ref
+                for parsed in futures.as_completed(parses):
+                    timings[parses[parsed]]['parse'] = parsed.result()
+
     raw = {}
     for ref in refs:
-        vs = retrieval.VariableSet(ref)
-        if refreshes.get(ref) or not vs.exists():
-            raw[ref] = xltable.RawXL(refs[ref])
-            vs.add(ref,raw[ref])
-            vs.save()
-        else:
-            vs.load()
-            raw[ref] = vs[ref]
+        start = time.perf_counter()
+        variable_sets[ref].load()
+        raw[ref] = variable_sets[ref][ref]
+        timings[ref]['load'] = time.perf_counter()-start
+        print(' {}: {}'.format(ref,', '.join('{} {:.2f}s'.format(step,timings[ref][step]) for step in timings[ref])))
 
-    return raw['tou'],raw['translations'],raw['rates']
+    return tuple(raw[ref] for ref in refs)
 
 def run_main():
     print('Setting up references')
@@ -55,4 +82,5 @@ def run_main():
     intercon_2  = physical.Interconnection(meter_1,['ground'])
     scenario_2 = physical.Scenario('solar',[intercon_2])
 
-run_main()
\ No newline at end of file
+if __name__=='__main__':
+    run_main()
\ No newline at end of file
@@ -0,0 +1,222 @@
+'''Load utility interval exports (CSV and Green Button XML) into intervals'''
+import pandas,numpy,os,fnmatch,re
+from typing import List
+from typing import Tuple
+from xml.etree import ElementTree
+from concurrent import futures
+import physical,retrieval,times
+
+# Green Button namespaces
+ns_atom = '{http://www.w3.org/2005/Atom}'
+ns_espi = '{http://naesb.org/espi}'
+
+# Green Button codes: unit of measure and flow direction from the customer's side
+uom_units = {72: 'kwh', 38: 'kw'}
+flow_directions = {1: 'export', 4: 'export', 19: 'import'}
+
+# header words that pick out columns of a CSV export
+csv_columns = {'meter': ['meter','service','account','sa_id','spid'],
+               'date': ['date','day'],
+               'time': ['time','start','interval','hour'],
+               'value': ['usage','value','reading','kwh','kw','demand','consumption'],
+               'unit': ['unit','uom'],
+               'direction': ['direction','channel','flow']}
+
+class Readings:
+    '''Timestamps and values of one meter and direction, gathered chunk by chunk as compact arrays'''
+    def __init__(self,unit:str='kwh',direction:str='export',ending:bool=False):
+        self.unit = unit
+        self.direction = direction
+        self.ending = ending
+        self.ns = []
+        self.values = []
+
+    def add(self,ns:numpy.ndarray,values:numpy.ndarray):
+        self.ns += [numpy.asarray(ns,dtype=numpy.int64)]
+        self.values += [numpy.asarray(values,dtype=numpy.float64)]
+
+    def merge(self,other):
+        self.ns += other.ns
+        self.values += other.values
+
+    def arrays(self) -> Tuple[numpy.ndarray]:
+        '''All readings in time order as one pair of arrays'''
+        ns = numpy.concatenate(self.ns) if len(self.ns) else numpy.zeros(0,dtype=numpy.int64)
+        values = numpy.concatenate(self.values) if len(self.values) else numpy.zeros(0)
+        if (numpy.diff(ns)<0).any():
+            order = numpy.argsort(ns,kind='stable')
+            ns,values = ns[order],values[order]
+        self.ns,self.values = [ns],[values]
+        return ns,values
+
+    def validate(self) -> physical.Validation:
+        '''Gaps, repeats and partial days of the readings so far'''
+        ns,_ = self.arrays()
+        return physical.validate(ns.view('datetime64[ns]'))
+
+    def interval(self,duplicates:str='last') -> physical.Interval:
+        ns,values = self.arrays()
+        interval = physical.Interval(ns.view('datetime64[ns]'),values,self.direction,self.unit,duplicates=duplicates)
+        if self.ending:
+            # readings were stamped at the end of each interval
+            interval.start -= interval.frequency
+        return interval
+
+def _find_column(headers:List[str],kind:str,taken:List[str]=[]) -> str:
+    '''First header that contains one of the words for a kind of column'''
+    for word in csv_columns[kind]:
+        for header in headers:
+            if (header not in taken) and (word in header.lower()):
+                return header
+    return None
+
+def _detect_unit(header:str,units:pandas.Series=None) -> Tuple[str,float]:
+    '''Unit and factor to kW or kWh from a unit column, else from the value header, else energy'''
+    text = (' '.join(units.dropna().astype(str).unique()) if units is not None else header or '').lower()
+    # whole unit words only, so words like power or flow are not read as watts
+    found = re.findall(r'(?<![a-z])(k?wh?)(?![a-z])',text)
+    if len(found):
+        unit = 'kwh' if found[0].endswith('h') else 'kw'
+        multiplier = 1 if found[0].startswith('k') else 1/1000
+    else:
+        unit,multiplier = 'kwh',1
+    return unit,multiplier
+
+def _detect_direction(values:pandas.Series) -> numpy.ndarray:
+    '''Direction of each reading, where received or negative flow is into the grid'''
+    text = values.astype(str).str.lower()
+    received = text.str.contains('receiv|revers|export|generat|negative|^19$')
+    return numpy.where(received,'import','export')
+
+def read_csv(file:str,chunksize:int=100000,columns:dict=None,unit:str=None,direction:str=None,
+             time_format:str=None,ending:bool=False,**kwargs) -> dict:
+    '''Stream a CSV export in chunks to readings by (meter, direction).
+    Columns are found from their headers unless named in columns, for example {'value':'Usage (kWh)'}.
+    Timestamps that mark the end of each interval are moved to the start with ending.'''
+    readings = {}
+    found = None
+    for chunk in pandas.read_csv(retrieval.fetch(file),chunksize=chunksize,**kwargs):
+        if found is None:
+            # work out columns and unit from the first chunk
+            found = dict(columns or {})
+            headers = list(chunk.columns)
+            for kind in ['value','meter','date','time','unit','direction']:
+                if kind not in found:
+                    found[kind] = _find_column(headers,kind,list(found.values()))
+            if found['time']==found['date']:
+                found['time'] = None
+            if found['date'] is None:
+                # one column holds the whole timestamp
+                found['date'],found['time'] = found['time'],None
+            if found['date'] is None:
+                raise ValueError("No timestamp column found in {}, name it with columns={{'date':...}}".format(file))
+            chunk_unit,multiplier = _detect_unit(found['value'],chunk[found['unit']] if found['unit'] else None)
+            chunk_unit = unit or chunk_unit
+
+        stamps = chunk[found['date']].astype(str)
+        if found['time'] is not None:
+            stamps = stamps+' '+chunk[found['time']].astype(str)
+        ns = numpy.asarray(pandas.to_datetime(stamps,format=time_format),dtype='datetime64[ns]').view(numpy.int64)
+        values = pandas.to_numeric(chunk[found['value']],errors='coerce').to_numpy(dtype=numpy.float64)*multiplier
+        meters = chunk[found['meter']].astype(str).to_numpy() if found['meter'] else numpy.full(len(chunk),'')
+        if direction is not None:
+            directions = numpy.full(len(chunk),direction)
+        elif found['direction'] is not None:
+            directions = _detect_direction(chunk[found['direction']])
+        else:
+            directions = numpy.full(len(chunk),'export')
+
+        # split chunk by meter and direction without looping over rows
+        keys,codes = numpy.unique(numpy.char.add(numpy.char.add(meters.astype(str),'|'),directions),return_inverse=True)
+        order = numpy.argsort(codes,kind='stable')
+        bounds = numpy.searchsorted(codes[order],numpy.arange(len(keys)+1))
+        for k,key in enumerate(keys):
+            meter,flow = key.rsplit('|',1)
+            rows = order[bounds[k]:bounds[k+1]]
+            readings.setdefault((meter,flow),Readings(chunk_unit,flow,ending)).add(ns[rows],values[rows])
+    return readings
+
+def _local_time(ns:numpy.ndarray,tz_offset:int,dst_offset:int) -> numpy.ndarray:
+    '''Move UTC epoch nanoseconds to local prevailing time, using US rules for when daylight saving applies'''
+    standard = ns+tz_offset*10**9
+    if dst_offset and len(ns):
+        years = standard.view('datetime64[ns]').astype('datetime64[Y]').view(numpy.int64)+1970
+        starts,ends = times.us_dst_days(years)
+        # 2am standard time in March until 2am daylight time in November
+        in_dst = (standard>=starts*times.ns_per_day+2*times.ns_per_hour) & \
+            (standard<ends*times.ns_per_day+times.ns_per_hour)
+        standard = standard+in_dst*dst_offset*10**9
+    return standard
+
+def read_green_button(file:str) -> dict:
+    '''Stream a Green Button XML export to readings by (usage point, direction).
+    Interval blocks take the reading type that comes before them in the feed.
+    Readings are stamped in UTC and moved to local prevailing time with the feed's local time parameters.'''
+    readings = {}
+    unit,multiplier,direction = 'kwh',1/1000,'export'
+    meter = ''
+    tz_offset,dst_offset = 0,0
+    with open(retrieval.fetch(file),'rb') as f:
+        for _,element in ElementTree.iterparse(f,events=['end']):
+            if element.tag==ns_atom+'link' and element.get('rel') in ['self','up']:
+                found = re.search(r'UsagePoint/([^/]+)',element.get('href',''))
+                if found:
+                    meter = found.group(1)
+            elif element.tag==ns_espi+'LocalTimeParameters':
+                tz_offset = int(element.findtext(ns_espi+'tzOffset','0'))
+                dst_offset = int(element.findtext(ns_espi+'dstOffset','0'))
+                element.clear()
+            elif element.tag==ns_espi+'ReadingType':
+                uom = int(element.findtext(ns_espi+'uom','72'))
+                power = int(element.findtext(ns_espi+'powerOfTenMultiplier','0'))
+                unit = uom_units.get(uom,'kwh')
+                multiplier = 10.0**power/1000
+                direction = flow_directions.get(int(element.findtext(ns_espi+'flowDirection','1')),'export')
+                element.clear()
+            elif element.tag==ns_espi+'IntervalBlock':
+                starts = []
+                values = []
+                for reading in element.iter(ns_espi+'IntervalReading'):
+                    starts += [reading.findtext(ns_espi+'timePeriod/'+ns_espi+'start')]
+                    values += [reading.findtext(ns_espi+'value')]
+                ns = numpy.array(starts,dtype=numpy.int64)*10**9
+                readings.setdefault((meter,direction),Readings(unit,direction)).add(
+                    ns,numpy.array(values,dtype=numpy.float64)*multiplier)
+                element.clear()
+            elif element.tag==ns_atom+'entry':
+                element.clear()
+    # local time parameters can come anywhere in the feed
+    for found in readings.values():
+        found.ns = [_local_time(ns,tz_offset,dst_offset) for ns in found.ns]
+    return readings
+
+def read_readings(file:str,**kwargs) -> dict:
+    '''Readings by (meter, direction) from a CSV or Green Button export'''
+    if file.lower().endswith('.xml'):
+        readings = read_green_button(file)
+    else:
+        readings = read_csv(file,**kwargs)
+    for key in readings:
+        readings[key].arrays()
+    return readings
+
+def read_intervals(file:str,**kwargs) -> dict:
+    '''Intervals by (meter, direction) from a CSV or Green Button export'''
+    readings = read_readings(file,**kwargs)
+    return {key: readings[key].interval() for key in readings}
+
+def read_folder(folder:str,pattern:str='*',workers:int=None,**kwargs) -> dict:
+    '''Intervals by (meter, direction) from every matching export in a folder, parsed in parallel.
+    A meter spread over several files is joined into one interval.'''
+    files = sorted(os.path.join(folder,f) for f in fnmatch.filter(os.listdir(folder),pattern) \
+        if f.lower().endswith(('.csv','.xml')))
+    readings = {}
+    with futures.ProcessPoolExecutor(workers) as pool:
+        jobs = {pool.submit(read_readings,file,**kwargs): file for file in files}
+        for job in futures.as_completed(jobs):
+            for key,found in job.result().items():
+                if key in readings:
+                    readings[key].merge(found)
+                else:
+                    readings[key] = found
+    return {key: readings[key].interval() for key in sorted(readings)}
@@ -1,54 +1,390 @@
 '''Physical objects'''
-import pandas,datetime
+import pandas,numpy,datetime,math,os
+from concurrent import futures
 from typing import List
+from typing import Tuple
 import org,times
 
 class Interval:
-    '''Basic object with times and measurements'''
-    def __init__(self,timestamps:pandas.DatetimeIndex,measurements:pandas.Series,direction:str='export',unit:str='kwh'):
-        '''Initialize interval'''
+    '''Basic object with times and measurements, held as one array on a fixed grid.
+    Version counts changes made in place, so anything built from the measurements can tell they changed.
+    A window keeps the interval it shares measurements with as its base, whose version changes with it.'''
+    __slots__ = ['values','start','frequency','unit','direction','version','base']
+
+    def __init__(self,timestamps:pandas.DatetimeIndex,measurements:pandas.Series,direction:str='export',unit:str='kwh',
+                 dtype:numpy.dtype=numpy.float64,duplicates:str='last'):
+        '''Initialize interval, placing measurements on a grid at the most common spacing of timestamps.
+        Measurements that land on the same grid point, like a repeated fall back hour, are combined
+        by keeping the first or last or taking the sum or mean.'''
+        ns = numpy.asarray(timestamps,dtype='datetime64[ns]').view(numpy.int64)
+        measurements = numpy.array(measurements,dtype=dtype)
+        if measurements.ndim>1:
+            measurements = measurements[:,0]
+        if (numpy.diff(ns)<0).any():
+            order = numpy.argsort(ns,kind='stable')
+            ns,measurements = ns[order],measurements[order]
         self.unit = unit
-
-        self.data = pandas.DataFrame(data=measurements)
-        self.data.columns = [unit]
         self.direction = direction
-        self.timestamps = timestamps
+        self.version = 0
+        self.base = None
+        self.start = int(ns[0]) if len(ns) else 0
+        self.frequency = self._most_common_step(ns)
+        positions = (ns-self.start)//self.frequency
+        if (len(ns)==0) or (positions[-1]==len(ns)-1 and (numpy.diff(positions)==1).all()):
+            self.values = numpy.ascontiguousarray(measurements)
+        elif duplicates in ['sum','mean']:
+            # missing readings are left empty
+            counts = numpy.bincount(positions)
+            self.values = numpy.bincount(positions,weights=measurements).astype(dtype)
+            if duplicates=='mean':
+                self.values /= numpy.maximum(counts,1)
+            self.values[counts==0] = numpy.nan
+        else:
+            # missing readings are left empty
+            self.values = numpy.full(positions.max()+1,numpy.nan,dtype=dtype)
+            if duplicates=='first':
+                self.values[positions[::-1]] = measurements[::-1]
+            else:
+                self.values[positions] = measurements
+
+    @classmethod
+    def from_array(cls,values:numpy.ndarray,start:int,frequency:int,direction:str='export',unit:str='kwh'):
+        '''Wrap an array that is already on a grid starting at epoch nanoseconds start'''
+        interval = cls.__new__(cls)
+        interval.values = values
+        interval.start = int(start)
+        interval.frequency = int(frequency)
+        interval.direction = direction
+        interval.unit = unit
+        interval.version = 0
+        interval.base = None
+        return interval
 
-        self.frequency = self.get_frequency()
-    
     def __repr__(self):
         return str(self.data)
 
-    def smooth_spikes(self):
+    def __len__(self):
+        return len(self.values)
+
+    def __getstate__(self):
+        return {slot: getattr(self,slot) for slot in self.__slots__}
+
+    def __setstate__(self,state):
+        self.version = 0
+        self.base = None
+        for slot in state:
+            setattr(self,slot,state[slot])
+
+    @property
+    def timestamps(self) -> pandas.DatetimeIndex:
+        '''Time of each measurement'''
+        return pandas.DatetimeIndex((self.start+self.frequency*numpy.arange(len(self.values))).view('datetime64[ns]'))
+
+    @property
+    def data(self) -> pandas.DataFrame:
+        '''Measurements as a dataframe, only built when asked for'''
+        return pandas.DataFrame({self.unit:self.values},copy=False)
+
+    def state(self) -> tuple:
+        '''Interval with its version and grid, which stops matching once either changes'''
+        return (self,self.version,self.start,self.frequency,len(self.values))
+
+    @property
+    def end(self) -> int:
+        '''Epoch nanoseconds just after last measurement'''
+        return self.start+self.frequency*len(self.values)
+
+    @staticmethod
+    def _most_common_step(ns:numpy.ndarray) -> int:
+        '''Spacing between timestamps that occurs most, leaving out repeats'''
+        steps = numpy.diff(ns)
+        steps = steps[steps>0]
+        if len(steps)==0:
+            return 15*60*10**9
+        steps,counts = numpy.unique(steps,return_counts=True)
+        return int(steps[numpy.argmax(counts)])
+
+    def _overlap(self,other) -> Tuple[slice]:
+        '''Views of self and other on the grid they share'''
+        if (other.frequency!=self.frequency) or ((other.start-self.start)%self.frequency):
+            raise ValueError('Intervals are not on the same grid')
+        first = max(self.start,other.start)
+        last = min(self.end,other.end)
+        if last<=first:
+            return slice(0,0),slice(0,0)
+        mine = slice((first-self.start)//self.frequency,(last-self.start)//self.frequency)
+        theirs = slice((first-other.start)//other.frequency,(last-other.start)//other.frequency)
+        return mine,theirs
+
+    def window(self,start:datetime.datetime,end:datetime.datetime):
+        '''Interval sharing the measurements between start and end'''
+        first,last = (numpy.datetime64(pandas.Timestamp(t),'ns').view(numpy.int64) for t in [start,end])
+        i = max(0,-(-(first-self.start)//self.frequency))
+        j = min(len(self.values),(last-self.start)//self.frequency+1)
+        window = Interval.from_array(self.values[i:max(i,j)],self.start+i*self.frequency,self.frequency,self.direction,self.unit)
+        window.base = self if self.base is None else self.base
+        return window
+
+    def _changed(self):
+        '''Count a change made in place, also in the interval whose measurements are shared'''
+        self.version += 1
+        if self.base is not None:
+            self.base.version += 1
+
+    def _combine(self,other,operation,inplace:bool=False):
+        '''Apply operation with a scalar, or with another interval where they overlap'''
+        result = self if inplace else Interval.from_array(self.values.copy(),self.start,self.frequency,self.direction,self.unit)
+        if isinstance(other,Interval):
+            mine,theirs = self._overlap(other)
+            operation(result.values[mine],other.values[theirs],out=result.values[mine])
+        else:
+            operation(result.values,other,out=result.values)
+        if inplace:
+            result._changed()
+        return result
+
+    def __add__(self,other):
+        return self._combine(other,numpy.add)
+
+    def __sub__(self,other):
+        return self._combine(other,numpy.subtract)
+
+    def __mul__(self,other):
+        return self._combine(other,numpy.multiply)
+
+    def __truediv__(self,other):
+        return self._combine(other,numpy.divide)
+
+    def __iadd__(self,other):
+        return self._combine(other,numpy.add,inplace=True)
+
+    def __isub__(self,other):
+        return self._combine(other,numpy.subtract,inplace=True)
+
+    def __neg__(self):
+        return Interval.from_array(-self.values,self.start,self.frequency,self.direction,self.unit)
+
+    def mul(self,other):
+        return self*other
+
+    def div(self,other):
+        return self/other
+
+    def smooth_spikes(self,snooze_min:int=4,zero:float=0.0):
         '''Spikes occur when a meter snoozes, which is evident when there are many zeroes.'''
-        # block measurements
-        blocking = self.data
-        blocking['blocks'] = ((self.data[[self.unit]]==0).cumsum()-(self.data[[self.unit]]==0).cumsum().where(
-            ~(self.data[[self.unit]]==0)).fillna(method='pad').fillna(0)).astype(int).shift().where(
-                self.data[[self.unit]]!=0).fillna(method='bfill')
-        # smooth out demand during snooze
-        blocking['smoothed'] = self.data[[self.unit]].where(self.data[[self.unit]]!=0).fillna(method='bfill')
-        # replace smoothed intervals when snooze period is longer than minimum span
-        blocking['smoothed'] = (blocking['smoothed'].div(blocking['blocks'])).where(
-            ((blocking['blocks']>=snooze_min)&((self.data[self.unit]==0)|(self.data[self.unit].shift()==0))),self.data[self.unit])
-        blocking = blocking.drop(['blocks',self.unit],axis=1).rename(columns={'smoothed':self.unit})
-        self.data = blocking
-
-    def get_frequency(self):
-        freq = pandas.Series(self.timestamps).diff().mode()
-        return freq
+        self.values = smooth_snoozes(self.values,snooze_min,zero)
+        self._changed()
+
+    def gaps(self) -> Tuple[numpy.ndarray]:
+        '''Grid position and length of each run of missing measurements'''
+        return _runs(numpy.isnan(self.values))
+
+    def fill(self,strategy:str='linear',limit:int=None):
+        '''Fill missing measurements in place, only in gaps up to limit long.
+        Strategies are zero, previous, linear, or day or week to repeat the same time one day or week before.'''
+        missing = numpy.isnan(self.values)
+        if not missing.any():
+            return
+        if limit is not None:
+            starts,lengths = self.gaps()
+            short = lengths<=limit
+            missing = numpy.zeros(len(self.values),dtype=bool)
+            missing[numpy.repeat(starts[short],lengths[short])+_run_offsets(lengths[short])] = True
+        positions = numpy.arange(len(self.values))
+        present = ~numpy.isnan(self.values)
+        if strategy=='zero':
+            filled = numpy.zeros(len(self.values))
+        elif strategy=='previous':
+            filled = self.values[numpy.maximum.accumulate(numpy.where(present,positions,0))]
+        elif strategy=='linear':
+            filled = numpy.interp(positions,positions[present],self.values[present]) if present.any() else self.values
+        elif strategy in ['day','week']:
+            # carry forward within each time of day or week
+            slots = (times.ns_per_day*(7 if strategy=='week' else 1))//self.frequency
+            rows = -(-len(self.values)//slots)
+            found = numpy.full(rows*slots,-1)
+            found[:len(self.values)] = numpy.where(present,positions,-1)
+            found = numpy.maximum.accumulate(found.reshape(rows,slots),axis=0).ravel()[:len(self.values)]
+            filled = numpy.where(found>=0,self.values[found.clip(0)],numpy.nan)
+        else:
+            raise ValueError('Unknown fill strategy {}'.format(strategy))
+        self.values = numpy.where(missing,filled,self.values)
+        self._changed()
+
+    def get_frequency(self) -> pandas.Timedelta:
+        return pandas.Timedelta(self.frequency)
 
     def convert_to_hourly(self):
         '''Change 60-min interval to 15-min interval'''
-        # check that data is not 15-min already
-        if self.frequency!='15min':
-            daterange = pandas.date_range(self.timestamps.min(),self.timestamps.max(),freq='15min')
-            df = pandas.DataFrame(self.data)
-            df.index = self.timestamps
-            converted = pandas.concat([df.reindex(daterange,method=m) for m in ['ffill','bfill']],axis=1).mean(1)
-            self.data = pandas.DataFrame(converted[self.unit])
-            self.timestamps = converted.index
-            self.freq = self.get_frequency()
+        converted = self.resample('15min')
+        self.values,self.start,self.frequency = converted.values,converted.start,converted.frequency
+        self._changed()
+
+    def resample(self,frequency):
+        '''Move to another frequency, splitting or summing energy and repeating or averaging demand'''
+        target = pandas.Timedelta(frequency).value
+        if target==self.frequency:
+            resampled = self
+        elif self.frequency%target==0:
+            resampled = self._upsample(target)
+        elif target%self.frequency==0:
+            resampled = self._downsample(target)
+        else:
+            # go through the finest grid both frequencies share
+            resampled = self._upsample(math.gcd(self.frequency,target))._downsample(target)
+        return resampled
+
+    def _upsample(self,target:int):
+        '''Split each measurement into equal parts'''
+        parts = self.frequency//target
+        values = numpy.repeat(self.values/parts if self.unit=='kwh' else self.values,parts)
+        return Interval.from_array(values,self.start,target,self.direction,self.unit)
+
+    def _downsample(self,target:int):
+        '''Combine measurements that fall in the same target period, including partial first and last periods'''
+        periods = (self.start+self.frequency*numpy.arange(len(self.values)))//target
+        firsts = numpy.flatnonzero(numpy.diff(periods,prepend=periods[0]-1)) if len(periods) else periods
+        values = numpy.add.reduceat(self.values,firsts) if len(firsts) else self.values[:0]
+        if self.unit!='kwh':
+            values = values/numpy.diff(numpy.append(firsts,len(self.values)))
+        start = int(periods[0])*target if len(periods) else self.start
+        return Interval.from_array(values,start,target,self.direction,self.unit)
+
+def common_grid(intervals:List[Interval],frequency=None) -> List[Interval]:
+    '''Bring intervals to one frequency, by default the finest among them, resampling only those that differ'''
+    target = min(i.frequency for i in intervals) if frequency is None else pandas.Timedelta(frequency).value
+    return [i.resample(target) for i in intervals]
+
+def _runs(flags:numpy.ndarray) -> Tuple[numpy.ndarray]:
+    '''Start and length of each run of true flags'''
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate([[False],flags,[False]]).astype(numpy.int8)))
+    return edges[::2],edges[1::2]-edges[::2]
+
+def _run_offsets(lengths:numpy.ndarray) -> numpy.ndarray:
+    '''Position within its run of every member of runs laid end to end'''
+    return numpy.arange(lengths.sum())-numpy.repeat(numpy.cumsum(lengths)-lengths,lengths)
+
+class Validation:
+    '''Missing, repeated and off-grid readings found on the grid of a set of timestamps.
+    Gaps and repeats in the hours daylight saving skips or repeats are flagged apart from the rest.'''
+    def __init__(self,start:int,frequency:int,length:int,gap_starts:numpy.ndarray,gap_lengths:numpy.ndarray,
+                 gap_dst:numpy.ndarray,repeats:numpy.ndarray,repeat_counts:numpy.ndarray,repeat_dst:numpy.ndarray,
+                 off_grid:int,partial_days:numpy.ndarray,partial_counts:numpy.ndarray):
+        self.start = start
+        self.frequency = frequency
+        self.length = length
+        self.gap_starts = gap_starts
+        self.gap_lengths = gap_lengths
+        self.gap_dst = gap_dst
+        self.repeats = repeats
+        self.repeat_counts = repeat_counts
+        self.repeat_dst = repeat_dst
+        self.off_grid = off_grid
+        self.partial_days = partial_days
+        self.partial_counts = partial_counts
+
+    def __repr__(self):
+        string = 'Grid: {} readings every {}\n'.format(self.length,pandas.Timedelta(self.frequency))
+        string += 'Gaps: {} ({} missing, {} daylight saving)\n'.format(len(self.gap_starts),self.gap_lengths.sum(),
+                                                                       self.gap_dst.sum())
+        string += 'Repeats: {} ({} daylight saving)\n'.format(len(self.repeats),self.repeat_dst.sum())
+        string += 'Off grid: {}\nPartial days: {}'.format(self.off_grid,len(self.partial_days))
+        return string
+
+    @property
+    def clean(self) -> bool:
+        '''Nothing missing, repeated or off grid apart from daylight saving'''
+        return (~self.gap_dst).sum()+(~self.repeat_dst).sum()+self.off_grid==0
+
+    def frame(self) -> pandas.DataFrame:
+        '''One row per gap or repeat'''
+        df = pandas.DataFrame({'issue':['gap']*len(self.gap_starts)+['repeat']*len(self.repeats),
+                               'start':pandas.to_datetime(self.start+self.frequency*numpy.concatenate(
+                                   [self.gap_starts,self.repeats]).astype(numpy.int64)),
+                               'readings':numpy.concatenate([self.gap_lengths,self.repeat_counts]),
+                               'dst':numpy.concatenate([self.gap_dst,self.repeat_dst])})
+        return df.sort_values('start',ignore_index=True)
+
+def validate(timestamps:pandas.DatetimeIndex,frequency=None) -> Validation:
+    '''Find gaps, repeats, off-grid readings and partial days in one sweep over timestamps, by default
+    on the grid of their most common spacing. Timestamps are taken as local time with US daylight saving.'''
+    ns = numpy.asarray(timestamps,dtype='datetime64[ns]').view(numpy.int64)
+    if (numpy.diff(ns)<0).any():
+        ns = numpy.sort(ns)
+    frequency = Interval._most_common_step(ns) if frequency is None else pandas.Timedelta(frequency).value
+    start = int(ns[0]) if len(ns) else 0
+    positions,offsets = numpy.divmod(ns-start,frequency)
+    counts = numpy.bincount(positions)
+    grid = start+frequency*numpy.arange(len(counts),dtype=numpy.int64)
+
+    gap_starts,gap_lengths = _runs(counts==0)
+    repeats = numpy.flatnonzero(counts>1)
+
+    # hour skipped at 2am in spring and hour repeated at 1am in fall
+    days = grid//times.ns_per_day
+    hours = (grid-days*times.ns_per_day)//times.ns_per_hour
+    first_day = int(days[0]) if len(days) else 0
+    years = numpy.unique(days.astype('datetime64[D]').astype('datetime64[Y]').view(numpy.int64)[[0,-1]]+1970) \
+        if len(days) else numpy.zeros(0,dtype=numpy.int64)
+    springs,falls = times.us_dst_days(numpy.arange(years.min(),years.max()+1) if len(years) else years)
+    spring = numpy.isin(days,springs) & (hours==2)
+    fall = numpy.isin(days,falls) & (hours==1)
+    in_spring = numpy.concatenate([[0],numpy.cumsum(spring)])
+    gap_dst = in_spring[gap_starts+gap_lengths]-in_spring[gap_starts]==gap_lengths
+    repeat_dst = fall[repeats] & (counts[repeats]==2)
+
+    # days with fewer readings than a full day, counting readings not points
+    per_day = numpy.bincount(days-first_day,weights=counts)
+    day_numbers = first_day+numpy.arange(len(per_day))
+    expected = numpy.full(len(per_day),times.ns_per_day//frequency)
+    expected[numpy.isin(day_numbers,springs)] -= times.ns_per_hour//frequency
+    expected[numpy.isin(day_numbers,falls)] += times.ns_per_hour//frequency
+    partial = numpy.flatnonzero(per_day<expected)
+
+    return Validation(start,frequency,len(counts),gap_starts,gap_lengths,gap_dst,repeats,counts[repeats],repeat_dst,
+                      int(numpy.count_nonzero(offsets)),day_numbers[partial].astype('datetime64[D]'),
+                      per_day[partial].astype(numpy.int64))
+
+def _snooze_runs(values:numpy.ndarray,snooze_min:int,zero:float) -> Tuple[numpy.ndarray]:
+    '''Start of each run of at least snooze_min zeroes and position of the spike that ends it'''
+    is_zero = numpy.abs(values)<=zero
+    edges = numpy.diff(numpy.concatenate([[0],is_zero.view(numpy.int8),[0]]))
+    starts = numpy.flatnonzero(edges==1)
+    ends = numpy.flatnonzero(edges==-1)
+    spiked = ((ends-starts)>=snooze_min) & (ends<len(values))
+    spiked[spiked] &= ~numpy.isnan(values[ends[spiked]])
+    return starts[spiked],ends[spiked]
+
+def smooth_snoozes(values:numpy.ndarray,snooze_min:int=4,zero:float=0.0) -> numpy.ndarray:
+    '''Spread each spike evenly over the run of zeroes before it and itself'''
+    smoothed = values.copy()
+    starts,spikes = _snooze_runs(values,snooze_min,zero)
+    counts = spikes-starts+1
+    positions = numpy.arange(counts.sum())-numpy.repeat(numpy.cumsum(counts)-counts-starts,counts)
+    smoothed[positions] = numpy.repeat(values[spikes]/counts,counts)
+    return smoothed
+
+class SnoozeSmoother:
+    '''Smooth snoozes over a series fed in chunks, holding back a run of zeroes left open at the end of a chunk'''
+    def __init__(self,snooze_min:int=4,zero:float=0.0):
+        self.snooze_min = snooze_min
+        self.zero = zero
+        self.held = numpy.zeros(0)
+
+    def feed(self,chunk:numpy.ndarray) -> numpy.ndarray:
+        '''Return smoothed values that can no longer change'''
+        values = numpy.concatenate([self.held,chunk])
+        is_zero = numpy.abs(values)<=self.zero
+        # zeroes at the end may still be followed by a spike
+        open_run = len(values)-numpy.argmin(is_zero[::-1]) if not is_zero.all() else 0
+        self.held = values[open_run:]
+        return smooth_snoozes(values[:open_run],self.snooze_min,self.zero)
+
+    def finish(self) -> numpy.ndarray:
+        '''Return zeroes still held, which no spike followed'''
+        held = self.held
+        self.held = numpy.zeros(0)
+        return held
 
 class Monitor:
     def __init__(self,name:str,interval:Interval=None):
@@ -74,26 +410,81 @@ class Asset(Monitor):
 class SolarArray(Asset):
     '''Solar asset'''
     def __init__(self,name:str,interval:Interval=None,inverter_size:float=None):
-        Asset.__init__(self,name,'solar',interval)
-    
+        Asset.__init__(self,name,'solar',interval,inverter_size)
+        self.projected = None
+
     def add_base_projection(self,interval:Interval,base_size:float):
+        '''Keep production per kW of inverter'''
         self.projected = interval.div(base_size)
-    def project_interval(self) -> Interval:
-        return self.project_interval.mul(inverter_size)
+
+    def project_interval(self,inverter_size:float=None) -> Interval:
+        '''Production for one inverter size, by default the installed size'''
+        return self.projected.mul(self.interver_size if inverter_size is None else inverter_size)
+
+    def project_sizes(self,inverter_sizes:List[float]) -> numpy.ndarray:
+        '''Production for many inverter sizes at once, one row per size'''
+        return numpy.multiply.outer(numpy.asarray(inverter_sizes,dtype=numpy.float64),self.projected.values)
+
+    def net_sizes(self,net_interval:Interval,inverter_sizes:List[float]) -> numpy.ndarray:
+        '''Net load on the grid of net interval after adding each inverter size, one row per size.
+        Production is only taken off where the projection overlaps.'''
+        mine,theirs = net_interval._overlap(self.projected)
+        net = numpy.repeat(net_interval.values[numpy.newaxis],len(inverter_sizes),axis=0)
+        net[:,mine] -= self.project_sizes(inverter_sizes)[:,theirs]
+        return net
 
 class Setpoints:
-    pass
+    '''Rules for when a battery charges and discharges.
+    Target caps net demand in kW, and can be one per battery size when sweeping sizes.
+    Without charge periods the battery charges any time it is not in a discharge period.'''
+    def __init__(self,target:float=None,charge_periods:List[str]=None,discharge_periods:List[str]=None,
+                 tou:times.TOU=None):
+        self.target = target
+        self.charge_periods = charge_periods
+        self.discharge_periods = discharge_periods
+        self.tou = tou
+
+    def masks(self,timestamps:times.Calendar) -> Tuple[numpy.ndarray]:
+        '''Flag each timestamp, or each point of a calendar, as allowed to charge and wanting to discharge'''
+        discharge = numpy.zeros(len(timestamps),dtype=bool)
+        charge = numpy.ones(len(timestamps),dtype=bool)
+        if (self.tou is not None) and (self.charge_periods or self.discharge_periods):
+            _,periods = self.tou.classify(timestamps)
+            if self.discharge_periods:
+                discharge = numpy.isin(periods,numpy.flatnonzero(numpy.isin(self.tou.period_names,self.discharge_periods)))
+            if self.charge_periods:
+                charge = numpy.isin(periods,numpy.flatnonzero(numpy.isin(self.tou.period_names,self.charge_periods)))
+        charge &= ~discharge
+        return charge,discharge
 
 class Battery(Asset):
     '''Battery asset'''
-    def __init__(self,name:str,interval:Interval=None,interver_size:float=None,capacity:float=None):
+    def __init__(self,name:str,interval:Interval=None,interver_size:float=None,capacity:float=None,
+                 efficiency:float=0.85):
         Asset.__init__(self,name,'battery',interval,interver_size)
         self.capacity = capacity
+        self.efficiency = efficiency
+        self.setpoints = Setpoints()
 
     def add_setpoints(self,setpoints:Setpoints):
         self.setpoints = setpoints
-    def project_interval(self,net_interval) -> Interval: # need demand
-        return None
+
+    def project_interval(self,net_interval:Interval,target:float=None) -> Interval:
+        '''Dispatch against net load, positive when discharging.
+        Target defaults to the setpoints, and picks one when they hold a target per size.'''
+        values = self.project_sizes(net_interval,[self.capacity],[self.interver_size],target)[0]
+        return Interval.from_array(values,net_interval.start,net_interval.frequency,'export',net_interval.unit)
+
+    def project_sizes(self,net_interval:Interval,capacities:List[float],inverter_sizes:List[float],
+                      target:float=None) -> numpy.ndarray:
+        '''Dispatch many battery sizes against the same net load at once, one row per size.
+        Target defaults to the setpoints and can be one per size.'''
+        hours = net_interval.frequency/(60*60*10**9)
+        per_kw = 1/hours if net_interval.unit=='kwh' else 1
+        charge,discharge = self.setpoints.masks(times.calendar(net_interval.start,net_interval.frequency,len(net_interval)))
+        kw = dispatch(numpy.nan_to_num(net_interval.values)*per_kw,hours,capacities,inverter_sizes,self.efficiency,
+                      self.setpoints.target if target is None else target,charge,discharge)
+        return kw.T/per_kw
 
 class Facility(Monitor):
     '''Physical object that has a name and measurements resulting from customer usage'''
@@ -104,11 +495,9 @@ class Facility(Monitor):
     def gross_up(self,assets:List[Asset]):
         '''Find the gross demand'''
         if self.amount!='gross':
-            baseline = facility
             # if data is given in net, add back asset interval
             for asset in assets:
-                baseline.interval.data += asset.interval.data
-        self.interval = baseline.interval
+                self.interval = self.interval + asset.interval
         self.amount = 'gross'
 
 class Portfolio:
@@ -127,25 +516,59 @@ class Meter:
             self.assets = []
         else:
             self.assets = assets
-        self.timestamps = self.facility.interval.timestamps
-        self.index = facility.interval.data.index
+        self._nets = {}
+        self._state = None
+
+    @property
+    def timestamps(self) -> pandas.DatetimeIndex:
+        return self.facility.interval.timestamps
+
+    @property
+    def index(self) -> pandas.RangeIndex:
+        return pandas.RangeIndex(len(self.facility.interval))
+
+    @property
+    def calendar(self) -> times.Calendar:
+        '''Calendar of the facility grid, shared with other meters on the same grid'''
+        interval = self.facility.interval
+        return times.calendar(interval.start,interval.frequency,len(interval))
 
     def __repr__(self):
         '''Show interval'''
-        return str(self.interval)
+        return str(self.facility.interval)
 
     def add_assets(self,assets:List[Asset]):
         self.assets += assets
+        self._nets = {}
+
+    def _refresh(self):
+        '''Forget net intervals once the facility or an asset interval is replaced or changed in place'''
+        state = tuple(monitor.interval.state() for monitor in [self.facility]+self.assets if monitor.interval is not None)
+        if state!=self._state:
+            self._state = state
+            self._nets = {}
 
     def combine_intervals(self,solarnames:List[str],storagenames:List[str]) -> Interval:
-        '''Subtract interval data from assets associated at stage to get net'''
-        interval = self.facility.interval
-        for asset in self.assets:
-            # subtract meters in stage
-            if ((asset.name in solarnames) & (asset.asset_type=='solar')) | \
-                ((asset.name in storagenames) & (asset.asset_type=='storage')):
-                interval.data -= asset.interval.data.mul(1 if asset.interval.direction=='export' else -1)
-        return interval
+        '''Subtract interval data from assets associated at stage to get net.
+        Facility interval is never changed and each combination is only computed once.'''
+        self._refresh()
+        gross = self.facility.interval
+        key = (frozenset(solarnames),frozenset(storagenames))
+        if key not in self._nets:
+            interval = gross
+            for asset in self.assets:
+                # subtract meters in stage
+                if ((asset.name in solarnames) & (asset.asset_type=='solar')) | \
+                    ((asset.name in storagenames) & (asset.asset_type=='battery')):
+                    if interval is gross:
+                        # first asset makes the copy that the rest are subtracted from
+                        interval = interval-asset.interval if asset.interval.direction=='export' else interval+asset.interval
+                    elif asset.interval.direction=='export':
+                        interval -= asset.interval
+                    else:
+                        interval += asset.interval
+            self._nets[key] = interval
+        return self._nets[key]
 
 class Interconnection:
     '''Combination of assets and facility at one meter'''
@@ -153,71 +576,235 @@ class Interconnection:
         self.meter = meter
         self.interval = meter.combine_intervals(solarnames,storagenames)
 
-        self.calendar = pandas.DataFrame()
-        self.calendar['month'] = meter.timestamps.month
-        self.calendar['date'] = meter.timestamps.date
-        self.calendar['dayofweek'] = meter.timestamps.dayofweek
-        self.calendar['time'] = meter.timestamps.time
-
-        self.timesofuse = pandas.DataFrame(index=meter.index,columns=['season','period'])
-
-    def classify_periods(self,tou:times.TOU,span:List[datetime.datetime]=None):
+        self.calendar = times.calendar(self.interval.start,self.interval.frequency,len(self.interval))
+        self.season_codes = numpy.full(len(self.interval),-1,dtype=numpy.int8)
+        self.period_codes = numpy.full(len(self.interval),-1,dtype=numpy.int8)
+        self.tou = None
+
+    @property
+    def timesofuse(self) -> pandas.DataFrame:
+        '''Season and period names of each reading, only built when asked for'''
+        classified = (self.season_codes>=0) & (self.period_codes>=0)
+        df = pandas.DataFrame(index=pandas.RangeIndex(len(self.season_codes)),columns=['season','period'])
+        if self.tou is not None:
+            seasons,periods = self.tou.labels(self.season_codes[classified],self.period_codes[classified])
+            df.loc[classified,'season'] = seasons
+            df.loc[classified,'period'] = periods
+        return df
+
+    def classify_periods(self,tou:times.TOU,span:List[datetime.datetime]=None,standard_time:bool=False):
         '''Identify seasons and times of use'''
-        span_index = self._get_span_index(self,span)
-        interval = pandas.DataFrame(index = span_index)
-        interval['holiday'] = 0
-
-        # classify days on/off
-        interval['dayoff'] = pandas.merge(self.calendar,tou.daysoff.weekdays,how='left',on=['dayofweek'])['dayoff']
-
-        if TOU.daysoff.holidaysoff:
-            interval['holiday'] = pandas.merge(self.calendar,tou.daysoff.holidays,how='left',on=['date'])['holiday']
-            interval['dayoff'] = interval['holiday'] | interval['dayoff']
-   
-        # classify seasons
-        interval['season'] = pandas.merge_asof(self.calendar,tou.seasons,
-                                               left_on=['month'],right_on=['start'],
-                                               how='left')['season']
-
-        # classify TOUs
-        interval['period'] = pandas.merge_asof(self.calendar,tou.periods,
-                                               left_on=['season','dayoff','time'],right_on=['season','dayoff','start'],
-                                               how='left')['period']
-
-        # add to interval
-        self.timesofuse.loc[span_index,:] = interval[['season','period']]
-
-    def bucket_quantities(self,span:List[datetime.datetime]=None) -> dict:
-        '''Bucket quantities over a timespan'''
-        span_index = self._get_span_index(self,span)
-        # stitch together dataframe
-        interval = pandas.concat([self.data,self.calendar],axis=1)
-        interval = interval[span_index,:]
-        # group by time of use for energy and demand
-        quantity_gb = interval.groupby(['season','period'])[[self.unit]]
-        # calculate values
-        quantity = {'days': interval['date'].nunique(),
-                    'kw': quantity_gb.max().mul(self._multiplier(self.unit)['kw']).reset_index(),
-                    'kwh': quantity_gb.sum().mul(self._multiplier(self.unit)['kwh']).reset_index(),
-                    'nbc': interval[interval[self.unit]>0][self.unit].sum()}
-        return quantity
-
-    def _get_span_index(self,span:List[datetime.datetime]) -> pandas.Int64Index:
-        '''Returns part of dataframe relevant to timespan'''
+        span_index = self._get_span_index(span)
+        seasons,periods = tou.classify(self.calendar[span_index],standard_time)
+        self.season_codes[span_index] = seasons
+        self.period_codes[span_index] = periods
+        self.tou = tou
+
+    def bucket_quantities(self,bill_dates:List[datetime.datetime]=None,values:numpy.ndarray=None) -> 'Quantities':
+        '''Bucket quantities for every billing period at once.
+        Bill dates are the boundaries between billing periods, and default to one bill over all readings.
+        Values default to the net interval, or can be one row per scenario on the same grid, like solar sizes.'''
+        if self.tou is None:
+            raise ValueError('Meter {} has not been classified, call classify_periods first'.format(self.meter.id))
+        return bucket_interval(self.interval,self.season_codes,self.period_codes,self.tou,bill_dates,values)
+
+    def _get_span_index(self,span:List[datetime.datetime]) -> slice:
+        '''Returns part of grid relevant to timespan'''
         if span is not None:
-            span_index = self.data[(self.data.index>=span.min())&
-                                   (self.data.index<=span.max())].index
+            first,last = (numpy.datetime64(pandas.Timestamp(t),'ns').view(numpy.int64) for t in [min(span),max(span)])
+            i = max(0,-(-(first-self.calendar.start)//self.calendar.frequency))
+            j = min(len(self.calendar),(last-self.calendar.start)//self.calendar.frequency+1)
+            span_index = slice(i,max(i,j))
         else:
-            span_index = self.data.index
+            span_index = slice(None)
         return span_index
 
-    def _multiplier(self,unit:str) -> int:
-        m = {'kw': 4 if unit=='kwh' else 1,
-             'kwh': 1 if unit=='kwh' else 1/4}
-        return m
+def multipliers(interval:Interval) -> dict:
+    '''Factors that turn readings into kW and kWh'''
+    hours = interval.frequency/(60*60*10**9)
+    m = {'kw': 1/hours if interval.unit=='kwh' else 1,
+         'kwh': 1 if interval.unit=='kwh' else hours}
+    return m
+
+def bucket_interval(interval:Interval,seasons:numpy.ndarray,periods:numpy.ndarray,tou:times.TOU,
+                    bill_dates:List[datetime.datetime]=None,values:numpy.ndarray=None) -> 'Quantities':
+    '''Bucket an interval already classified by season and period codes into billing periods'''
+    ns = interval.start+interval.frequency*numpy.arange(len(interval),dtype=numpy.int64)
+    if bill_dates is None:
+        bill_dates = [pandas.Timestamp(interval.start),pandas.Timestamp(interval.end)]
+    bounds = numpy.asarray(pandas.to_datetime(bill_dates),dtype='datetime64[ns]').view(numpy.int64)
+    bills = numpy.searchsorted(bounds,ns,side='right')-1
+    bills[bills>=len(bounds)-1] = -1
+    multiplier = multipliers(interval)
+    quantities = bucket(interval.values if values is None else values,seasons,periods,bills,ns//times.ns_per_day,
+                        len(tou.season_names),len(tou.period_names),len(bounds)-1,multiplier['kw'],multiplier['kwh'])
+    return Quantities(bill_dates,tou.season_names,tou.period_names,*quantities)
+
+def dispatch(load:numpy.ndarray,hours:float,capacities:List[float],inverter_sizes:List[float],efficiency:float,
+             target:float=None,charge:numpy.ndarray=None,discharge:numpy.ndarray=None,
+             state:float=1.0) -> numpy.ndarray:
+    '''Battery kW at each step for each size, positive when discharging, starting at a fraction of capacity.
+    Discharge shaves load above target or serves all load in discharge steps without exporting,
+    and charge fills up to target or up to the inverter without a target.
+    Losses are split evenly between charging and discharging.'''
+    capacity = numpy.asarray(capacities,dtype=numpy.float64)
+    inverter = numpy.broadcast_to(numpy.asarray(inverter_sizes,dtype=numpy.float64),capacity.shape)
+    target = numpy.inf if target is None else numpy.asarray(target,dtype=numpy.float64)
+    if numpy.size(target) not in [1,len(capacity)]:
+        raise ValueError('{} targets given for {} battery sizes'.format(numpy.size(target),len(capacity)))
+    target = numpy.broadcast_to(numpy.reshape(target,-1) if numpy.ndim(target) else target,capacity.shape)
+    charge = numpy.ones(len(load),dtype=bool) if charge is None else charge
+    discharge = numpy.zeros(len(load),dtype=bool) if discharge is None else discharge
+    leg = math.sqrt(efficiency)
+    soc = capacity*state
+    kw = numpy.empty((len(load),len(capacity)))
+    for t in range(len(load)):
+        # kW wanted, positive to discharge and negative to charge
+        wanted = numpy.maximum(load[t],0) if discharge[t] else numpy.maximum(load[t]-target,0)
+        if charge[t]:
+            room = numpy.minimum(target-load[t],inverter)
+            wanted = numpy.where(wanted>0,wanted,-numpy.maximum(room,0))
+        out = numpy.minimum(numpy.minimum(wanted,inverter),soc*leg/hours)
+        into = numpy.minimum(numpy.minimum(-wanted,inverter),(capacity-soc)/(leg*hours))
+        power = numpy.where(wanted>0,out,-numpy.maximum(into,0))
+        soc -= numpy.where(power>0,power/leg,power*leg)*hours
+        kw[t] = power
+    return kw
+
+def bucket(values:numpy.ndarray,seasons:numpy.ndarray,periods:numpy.ndarray,bills:numpy.ndarray,days:numpy.ndarray,
+           n_seasons:int,n_periods:int,n_bills:int,kw_multiplier:float=4,kwh_multiplier:float=1) -> Tuple[numpy.ndarray]:
+    '''Energy and peak demand per (bill, season, period), and days and positive energy per bill, in one pass.
+    Values can have one row per scenario, which adds a leading axis to energy, demand and positive energy.
+    Codes of -1 are left out and readings must be in time order.'''
+    rows = numpy.atleast_2d(values)
+    n_rows = len(rows)
+    size = n_bills*n_seasons*n_periods
+    coded = (bills>=0) & (seasons>=0) & (periods>=0)
+    keys = (bills.astype(numpy.int64)*n_seasons+seasons)*n_periods+periods
+    valid = coded & ~numpy.isnan(rows)
+    keys = (keys+size*numpy.arange(n_rows)[:,numpy.newaxis])[valid]
+    kept = rows[valid]
+    kwh = numpy.bincount(keys,weights=kept,minlength=n_rows*size)*kwh_multiplier
+    # peaks from the sorted runs of each key
+    kw = numpy.full(n_rows*size,numpy.nan)
+    if len(keys):
+        order = numpy.argsort(keys,kind='stable')
+        sorted_keys = keys[order]
+        firsts = numpy.flatnonzero(numpy.diff(sorted_keys,prepend=-1))
+        kw[sorted_keys[firsts]] = numpy.maximum.reduceat(kept[order],firsts)*kw_multiplier
+    # a day counts once per bill it has readings in
+    billed = bills>=0
+    new_day = numpy.diff(days,prepend=days[:1]-1)!=0
+    new_day |= numpy.diff(bills,prepend=-2)!=0
+    day_count = numpy.bincount(bills[billed & new_day],minlength=n_bills)
+    nbc = numpy.nan_to_num(rows[:,billed]).clip(0) @ (bills[billed][:,numpy.newaxis]==numpy.arange(n_bills))*kwh_multiplier
+    shape = (n_rows,n_bills,n_seasons,n_periods)
+    kwh,kw = kwh.reshape(shape),kw.reshape(shape)
+    if numpy.ndim(values)==1:
+        kwh,kw,nbc = kwh[0],kw[0],nbc[0]
+    return kwh,kw,day_count,nbc
+
+class Quantities:
+    '''Energy, peak demand, days and positive energy by billing period, with energy and demand by season and period.
+    Energy, demand and positive energy have a leading axis when bucketed for many scenarios.'''
+    def __init__(self,bill_dates:List[datetime.datetime],season_names:numpy.ndarray,period_names:numpy.ndarray,
+                 kwh:numpy.ndarray,kw:numpy.ndarray,days:numpy.ndarray,nbc:numpy.ndarray):
+        self.bill_dates = bill_dates
+        self.season_names = season_names
+        self.period_names = period_names
+        self.kwh = kwh
+        self.kw = kw
+        self.days = days
+        self.nbc = nbc
+
+    def __repr__(self):
+        return str(self.frame())
+
+    def frame(self) -> pandas.DataFrame:
+        '''Energy and demand by scenario, bill, season and period where there were readings'''
+        found = numpy.nonzero(~numpy.isnan(self.kw))
+        bills,seasons,periods = found[-3:]
+        df = pandas.DataFrame({'bill':bills,
+                               'season':self.season_names[seasons],
+                               'period':self.period_names[periods],
+                               'kwh':self.kwh[found],
+                               'kw':self.kw[found]})
+        if self.kw.ndim==4:
+            df.insert(0,'scenario',found[0])
+        return df
 
 class Scenario:
     '''Group of various simultaneous interconnections of meters and assets'''
     def __init__(self,name:str,interconnections:List[Interconnection]):
         self.name = name
-        self.interconnections = interconnections
\ No newline at end of file
+        self.interconnections = interconnections
+
+    def evaluate(self,tou:times.TOU=None,bill_dates:List[datetime.datetime]=None,workers:int=None) -> dict:
+        '''Quantities of each meter in the scenario'''
+        results = evaluate([self],tou,bill_dates,workers)
+        return {meter_id: results[(self.name,meter_id)] for _,meter_id in results}
+
+# read-only tables each worker process keeps for every task it runs
+_shared = {}
+
+def _share(tables:dict):
+    '''Keep read-only tables in a worker process'''
+    _shared.update(tables)
+
+def _evaluate(tasks:list,bill_dates:List[datetime.datetime]) -> list:
+    '''Bucket net intervals sent as bare arrays with the TOU each was classified with, in a worker process.
+    Intervals sent without codes are classified here.'''
+    results = []
+    for key,values,start,frequency,unit,tou_key,seasons,periods in tasks:
+        tou = _shared['tous'][tou_key]
+        interval = Interval.from_array(values,start,frequency,'export',unit)
+        if seasons is None:
+            seasons,periods = tou.classify(times.calendar(interval.start,interval.frequency,len(interval)))
+        results += [(key,bucket_interval(interval,seasons,periods,tou,bill_dates))]
+    return results
+
+def evaluate(scenarios:List[Scenario],tou:times.TOU=None,bill_dates:List[datetime.datetime]=None,workers:int=None,
+             chunks_per_worker:int=4) -> dict:
+    '''Quantities of every interconnection in every scenario by (scenario name, meter id), across a process pool.
+    Interconnections already classified keep their own TOU and codes, and the rest are classified with tou.
+    Each distinct TOU is compiled and sent once to each worker rather than with each task,
+    and a net interval shared by several scenarios with the same codes is only evaluated once.'''
+    tous = {}
+    owners = {}
+    tasks = {}
+    for scenario in scenarios:
+        for interconnection in scenario.interconnections:
+            used = tou if interconnection.tou is None else interconnection.tou
+            if used is None:
+                raise ValueError('Meter {} is not classified and no TOU was given'.format(interconnection.meter.id))
+            if not used.compiled:
+                used.compile()
+            tou_key = (used.subTOU,used.schedule)
+            tous[tou_key] = used
+            interval = interconnection.interval
+            if interconnection.tou is None:
+                seasons,periods,codes = None,None,None
+            else:
+                seasons,periods = interconnection.season_codes,interconnection.period_codes
+                codes = seasons.tobytes()+periods.tobytes()
+            key = (id(interval),tou_key,codes)
+            if key not in tasks:
+                # numbered so only the number comes back with the results
+                tasks[key] = (len(tasks),interval.values,interval.start,interval.frequency,interval.unit,
+                              tou_key,seasons,periods)
+            owners.setdefault(tasks[key][0],[]).append((scenario.name,interconnection.meter.id))
+    tasks = list(tasks.values())
+
+    workers = workers or os.cpu_count()
+    size = max(1,math.ceil(len(tasks)/(workers*chunks_per_worker)))
+    results = {}
+    with futures.ProcessPoolExecutor(workers,initializer=_share,initargs=({'tous':tous},)) as pool:
+        jobs = [pool.submit(_evaluate,tasks[i:i+size],bill_dates) for i in range(0,len(tasks),size)]
+        done = 0
+        for job in futures.as_completed(jobs):
+            for key,quantities in job.result():
+                for owner in owners[key]:
+                    results[owner] = quantities
+                done += 1
+            print(' {}/{} intervals evaluated'.format(done,len(tasks)))
+    return results
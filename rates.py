@@ -1,7 +1,15 @@
 '''Charges and credits for all utility/provider rates'''
-import pandas,datetime
-import xltable,org,times
+import pandas,numpy,datetime,re
+import xltable,org,times,retrieval
 from typing import List
+from typing import Tuple
+
+# unit word that starts a charge code, longest first so kwh is not read as kw
+unit_code = re.compile('customer|kwh|kw|nbc')
+# component after the unit and any season-period, as in kwh_d or kwh1-3_d
+component_code = re.compile(r'(?:kwh|kw|nbc)(?:\d?-\d)?.(\w+)$')
+# CRS type on the end of a surcharge code, as in nbc_d_pcia
+crs_code = re.compile(r'_(pcia|cca|da)$')
 
 class RateTariff:
     '''Basic rules of a rate tariff'''
@@ -45,122 +53,344 @@ class ServiceAgreement:
         self.start = start
         self._parameters = parameters
     def __getattr__(self,attribute):
-        return self._parameters[attribute]
+        if attribute.startswith('__') or attribute=='_parameters':
+            raise AttributeError(attribute)
+        return self._parameters.get(attribute)
+    def fingerprint(self) -> tuple:
+        '''Hashable summary of the agreement, with rates and providers by name'''
+        return (self.start,)+tuple((key,getattr(value,'name',value)) for key,value in sorted(self._parameters.items()))
 
 class RatesDB:
     '''Object that holds all rate tables for a utility'''
     def __init__(self,tables:xltable.RawXL,utility:org.IOU):
         self.utility = utility
-        self.data = tables.data
-        self._refine_utility()
+        self.tables = tables.data
+        self.data = retrieval.LazyTables(self.tables,self._refine_utility)
+
+    def _refine_utility(self,tbl:str) -> pandas.DataFrame:
+        df = self.tables[tbl]
+        if 'utility' in df.columns:
+            df = df[df['utility']==self.utility.name].drop('utility',axis=1)
+        return df
 
-    def _refine_utility(self):
-        for tbl in self.data:
-            df = self.data[tbl]
-            if 'utility' in df.columns:
-                self.data[tbl] = df[df['utility']==self.utility.name].drop('utility',axis=1)
+class ChargeTable:
+    '''Charges in force on one date summed into a dense array indexed by integer codes of each dimension.
+    Past the names of each dimension are a code for rows with nothing in that column
+    and a code for names that are not in the table, which never has charges.'''
+    dimensions = ['unit','season','period','component','level','crs type']
+
+    def __init__(self,df:pandas.DataFrame,value:str='value'):
+        self.codes = {}
+        codes = []
+        for dimension in self.dimensions:
+            if dimension in df.columns:
+                column = df[dimension].to_numpy()
+                code,names = pandas.factorize(column)
+                code[code<0] = len(names)
+            else:
+                names = []
+                code = numpy.zeros(len(df),dtype=numpy.int64)
+            self.codes[dimension] = {name: i for i,name in enumerate(names)}
+            codes += [code]
+        shape = tuple(len(self.codes[d])+2 for d in self.dimensions)
+        keys = numpy.ravel_multi_index(codes,shape) if len(df) else numpy.zeros(0,dtype=numpy.int64)
+        charges = pandas.to_numeric(df[value],errors='coerce').fillna(0).to_numpy() if len(df) else numpy.zeros(0)
+        self.charges = numpy.bincount(keys,weights=charges,minlength=int(numpy.prod(shape))).reshape(shape)
+        self._reduced = {}
+
+    def code(self,dimension:str,values):
+        '''Integer code of a name, or of each of a list of names, with nulls to the empty code'''
+        codes = self.codes[dimension]
+        if numpy.ndim(values):
+            return numpy.array([self.code(dimension,value) for value in values],dtype=numpy.int64)
+        if (values is None) or (values!=values):
+            return len(codes)
+        return codes.get(values,len(codes)+1)
+
+    def _reduce(self,**criteria) -> Tuple[numpy.ndarray,tuple]:
+        '''Charges summed over dimensions left open or given a set of components, and codes for the remaining ones.
+        Each way of summing is only done once.'''
+        index = []
+        summed = []
+        for dimension in self.dimensions:
+            values = criteria.get(dimension)
+            if (values is None) or (dimension!='unit' and len(self.codes[dimension])==0):
+                # not asked for or not in schedule
+                summed += [None]
+            elif (dimension=='component') and numpy.ndim(values):
+                summed += [tuple(values)]
+            else:
+                summed += [True]
+                index += [self.code(dimension,values)]
+        summed = tuple(summed)
+        if summed not in self._reduced:
+            charges = self.charges
+            for axis in reversed(range(len(summed))):
+                if summed[axis] is None:
+                    charges = charges.sum(axis=axis)
+                elif summed[axis] is not True:
+                    charges = charges.take(self.code(self.dimensions[axis],summed[axis]),axis=axis).sum(axis=axis)
+            self._reduced[summed] = charges
+        return self._reduced[summed],tuple(index)
+
+    def lookup(self,unit:str,season:str=None,period:str=None,components:List[str]=None,
+               level:int=None,crs_type:str=None) -> float:
+        '''Sum of all charges that match, where a criterion left as None matches everything'''
+        charges,index = self._reduce(unit=unit,season=season,period=period,
+                                     component=components,level=level,**{'crs type':crs_type})
+        return float(charges[index])
+
+    def lookup_many(self,units:List[str],seasons:List[str]=None,periods:List[str]=None,
+                    components:List[str]=None,level:int=None,crs_type:str=None) -> numpy.ndarray:
+        '''Charges for each of a list of units, seasons and periods at once, such as every line of a bill.
+        A single season, period, level or CRS type applies to every line.'''
+        charges,index = self._reduce(unit=list(units),
+                                     season=seasons if numpy.ndim(seasons)==0 else list(seasons),
+                                     period=periods if numpy.ndim(periods)==0 else list(periods),
+                                     component=components,level=level,**{'crs type':crs_type})
+        return numpy.broadcast_to(charges[index],(len(units),))
 
 class RateSchedule:
     '''All charges and credits for a set of parameters'''
-    def __init__(self,category:str,dataframe:pandas.DataFrame,**parameters):
+    def __init__(self,category:str,dataframe:pandas.DataFrame,utility_rates=None,crs_rates=None,**parameters):
         self.category = category
         self.schedule = dataframe
+        self.utility_rates = utility_rates
+        self.crs_rates = crs_rates
         self._parameters = parameters
+        self._tables = {}
+        self._substitutes = None
+        self._breakpoints = None
+        self._sources = {}
+        self._resolved = {}
 
     def __getattr__(self,attribute):
+        if attribute.startswith('__') or attribute=='_parameters':
+            raise AttributeError(attribute)
         return self._parameters[attribute]
 
+    def table(self,effective:datetime.datetime) -> ChargeTable:
+        '''Charges in force on a date compiled for lookups, built the first time those rates are used'''
+        in_force = int(self.in_force(effective).astype(numpy.int64))
+        if in_force not in self._tables:
+            self._tables[in_force] = ChargeTable(self.extract(effective))
+        return self._tables[in_force]
+
+    @property
+    def breakpoints(self) -> numpy.ndarray:
+        '''Sorted dates that rates change on, as epoch nanoseconds'''
+        if self._breakpoints is None:
+            self._breakpoints = numpy.unique(numpy.asarray(self.schedule['effective'].dropna(),
+                                                           dtype='datetime64[ns]').view(numpy.int64))
+        return self._breakpoints
+
+    def in_force(self,dates) -> numpy.ndarray:
+        '''Effective date of the rates in force on each date, or NaT before the first'''
+        if numpy.ndim(dates)==0:
+            ns = numpy.int64(pandas.Timestamp(dates).as_unit('ns').value)
+        else:
+            ns = numpy.asarray(pandas.to_datetime(dates),dtype='datetime64[ns]').view(numpy.int64)
+        found = numpy.searchsorted(self.breakpoints,ns,side='right')-1
+        effective = numpy.where(found>=0,self.breakpoints[found.clip(0)] if len(self.breakpoints) else 0,
+                                numpy.datetime64('NaT').view(numpy.int64))
+        effective = effective.view('datetime64[ns]')
+        return effective if effective.ndim else effective[()]
+
     def extract(self,effective:datetime.datetime) -> pandas.DataFrame: # by charge? by component?
-        '''Returns a dataframe with charges for effective date'''
-        return self.schedule[self.schedule['effective']==effective]
+        '''Returns a dataframe with charges in force on a date'''
+        return self.schedule[self.schedule['effective']==self.in_force(effective)]
+
+    def split_periods(self,starts:List[datetime.datetime],ends:List[datetime.datetime],
+                      breakpoints:numpy.ndarray=None) -> Tuple[numpy.ndarray]:
+        '''Split billing periods where rates change, by default where this schedule changes.
+        Returns for each piece its billing period, start, end, effective date and share of the period.'''
+        starts = numpy.asarray(pandas.to_datetime(starts),dtype='datetime64[ns]').view(numpy.int64)
+        ends = numpy.asarray(pandas.to_datetime(ends),dtype='datetime64[ns]').view(numpy.int64)
+        breakpoints = self.breakpoints if breakpoints is None else breakpoints
+        # rate changes inside each period, not on its edges
+        firsts = numpy.searchsorted(breakpoints,starts,side='right')
+        changes = numpy.searchsorted(breakpoints,ends,side='left')-firsts
+        pieces = numpy.maximum(changes,0)+1
+        bills = numpy.repeat(numpy.arange(len(starts)),pieces)
+        nth = numpy.arange(pieces.sum())-numpy.repeat(numpy.cumsum(pieces)-pieces,pieces)
+        inner = breakpoints[(firsts[bills]+nth-1).clip(0,max(len(breakpoints)-1,0))] if len(breakpoints) else starts[bills]
+        piece_starts = numpy.where(nth==0,starts[bills],inner)
+        last = nth==pieces[bills]-1
+        piece_ends = numpy.where(last,ends[bills],numpy.roll(piece_starts,-1))
+        shares = (piece_ends-piece_starts)/numpy.maximum(ends-starts,1)[bills]
+        return bills,piece_starts.view('datetime64[ns]'),piece_ends.view('datetime64[ns]'), \
+            self.in_force(piece_starts.view('datetime64[ns]')),shares
+
+    def prorate(self,service_agreement:ServiceAgreement,starts:List[datetime.datetime],ends:List[datetime.datetime],
+                units:List[str],seasons:List[str]=None,periods:List[str]=None,components:List[str]=None,
+                level:int=None,crs_type:str=None) -> numpy.ndarray:
+        '''Charges for each line of each billing period, weighting the rates in force by their share of the period.
+        Returns one row per billing period.'''
+        sources = self._get_sources(service_agreement)
+        breakpoints = numpy.unique(numpy.concatenate([self.breakpoints]+[source.breakpoints for source in sources]))
+        bills,piece_starts,_,effective,shares = self.split_periods(starts,ends,breakpoints)
+        prorated = numpy.zeros((len(starts),len(units)))
+        if len(bills):
+            # one table for each combination of rates in force
+            keys = numpy.stack([effective]+[source.in_force(piece_starts) for source in sources],axis=1)
+            _,firsts,pieces = numpy.unique(keys.view(numpy.int64),axis=0,return_index=True,return_inverse=True)
+            charges = numpy.stack([self._get_table(service_agreement,piece_starts[first]).lookup_many(
+                units,seasons,periods,components,level,crs_type) for first in firsts])
+            numpy.add.at(prorated,bills,charges[pieces.ravel()]*shares[:,numpy.newaxis])
+        return prorated
 
     def get_charge(self,service_agreement:ServiceAgreement,effective:datetime.datetime,unit:str,
                     season:str=None,period:str=None,components:List[str]=None,level:int=None,crs_type:str=None):
         '''Retuns sum of all charges that match parameters'''
-        df = self.schedule
-        # replace OAT with original tariff
-        if (self.category!='utility') & ('OAT' in df['rate']):
-            df = self._replace_oat(self,df,service_agreement)
-        # replace nonbypassible from CRS with responsibility tariff
-        if (self.category=='utility') & ('CRS' in df['rate']):
-            df = self._replace_crs(self,df,service_agreement)
-        # return slice of dataframe that matches parameters
-        truth_value = self._get_truth(df,season,period,components,level,crs_type)
-        charge = pandas.to_numeric(df[truth_value]).sum()
+        effective = pandas.Timestamp(effective)
+        table = self._get_table(service_agreement,effective)
+        charge = table.lookup(unit,season,period,components,level,crs_type)
         return charge
 
-    def _replace_oat(self,df:pandas.DataFrame,service_agreement:ServiceAgreement) -> pandas.DataFrame:
-        merge_cols = ['unit','season','period','component','level']
-        utility_df = utility_rates.extract(service_agreement)
-        df.loc[df['rate']=='OAT','rate'] = \
-            df.merge(utility_df,how='left',on=merge_cols,suffixes=['_',''])['rate']
-        return df
+    def get_charges(self,service_agreement:ServiceAgreement,effective:datetime.datetime,units:List[str],
+                    seasons:List[str]=None,periods:List[str]=None,components:List[str]=None,level:int=None,
+                    crs_type:str=None) -> numpy.ndarray:
+        '''Returns charges for each unit, season and period of a bill in one lookup'''
+        effective = pandas.Timestamp(effective)
+        table = self._get_table(service_agreement,effective)
+        return table.lookup_many(units,seasons,periods,components,level,crs_type)
+
+    def _marked(self,df:pandas.DataFrame,marker:str) -> pandas.Series:
+        '''Rows whose charge stands for a charge from another schedule'''
+        return df['value'].astype(str)==marker
+
+    def _get_sources(self,service_agreement:ServiceAgreement) -> list:
+        '''Schedules that OAT and CRS charges are taken from, found once per agreement'''
+        if self._substitutes is None:
+            self._substitutes = {'oat': (self.category!='utility') and self._marked(self.schedule,'OAT').any(),
+                                 'crs': (self.category=='utility') and self._marked(self.schedule,'CRS').any()}
+        if not (self._substitutes['oat'] or self._substitutes['crs']):
+            return []
+        key = service_agreement.fingerprint()
+        if key not in self._sources:
+            sources = []
+            for substitute,source in [('oat','utility_rates'),('crs','crs_rates')]:
+                if self._substitutes[substitute] and getattr(self,source) is None:
+                    raise ValueError('{} schedule has {} charges but no {} to take them from'.format(
+                        self.category,substitute.upper(),source))
+            if self._substitutes['oat']:
+                sources += [self.utility_rates.extract(service_agreement)]
+            if self._substitutes['crs']:
+                crs_schedule = self.crs_rates.extract(service_agreement).schedule
+                # surcharges without a type apply whoever provides
+                crs_types = crs_schedule['crs type']
+                crs_type = self._get_crs_type(service_agreement)
+                sources += [RateSchedule('crs',crs_schedule[crs_types.isnull() | (crs_types==crs_type)])]
+            self._sources[key] = sources
+        return self._sources[key]
+
+    def _get_table(self,service_agreement:ServiceAgreement,effective:datetime.datetime) -> ChargeTable:
+        '''Compiled charges, with the charges that OAT and CRS stand for swapped in.
+        These are resolved once for each agreement and combination of rates in force, without changing the schedule.'''
+        sources = self._get_sources(service_agreement)
+        if len(sources)==0:
+            return self.table(effective)
+        in_force = (self.in_force(effective),)+tuple(source.in_force(effective) for source in sources)
+        key = (service_agreement.fingerprint(),)+in_force
+        if key not in self._resolved:
+            df = self.extract(effective)
+            # replace OAT with original tariff
+            if self._substitutes['oat']:
+                df = self._replace_oat(df,sources[0].extract(effective))
+            # replace nonbypassible from CRS with responsibility tariff
+            if self._substitutes['crs']:
+                df = self._replace_crs(df,sources[-1].extract(effective),service_agreement)
+            self._resolved[key] = ChargeTable(df)
+        return self._resolved[key]
+
+    def _replace_oat(self,df:pandas.DataFrame,utility_df:pandas.DataFrame) -> pandas.DataFrame:
+        '''Take OAT charges from the otherwise applicable utility tariff'''
+        merge_cols = [c for c in ['unit','season','period','component','level'] if c in df.columns]
+        oat = self._marked(df,'OAT')
+        replaced = df[oat].drop(columns='value').merge(utility_df[merge_cols+['value']],how='left',on=merge_cols)
+        self._check_replaced(replaced,'OAT',merge_cols)
+        return pandas.concat([df[~oat],replaced],ignore_index=True)
+
+    def _check_replaced(self,replaced:pandas.DataFrame,marker:str,merge_cols:List[str]):
+        '''Every charge that stands for another must find it, rather than be dropped'''
+        missing = replaced['value'].isnull()
+        if missing.any():
+            charges = [' '.join(str(v) for v in row if not pandas.isnull(v)) for row in
+                       replaced.loc[missing,merge_cols].drop_duplicates().itertuples(index=False)]
+            raise ValueError('No {} charge found for {}'.format(marker,', '.join(charges)))
 
     def _get_crs_type(self,service_agreement:ServiceAgreement) -> str:
         if service_agreement.provider is not None:
             crs_type = service_agreement.provider.providing
-        elif (service_agreement.standby is not None) | force:
+        elif service_agreement.standby is not None:
             crs_type = 'pcia'
         else:
             crs_type = None
         return crs_type
 
-    def _replace_crs(self,df,service_agreement:ServiceAgreement) -> pandas.DataFrame:
-        crs_type = self._get_crs_type(service_agreement)
-        replace_all_nbc = False
-        if service_agreement.provider is not None:
-            replace_all_nbc = True
-        elif service_agreement.standby is not None:
-            replace_all_nbc = True
+    def _replace_crs(self,df:pandas.DataFrame,crs_df:pandas.DataFrame,service_agreement:ServiceAgreement) -> pandas.DataFrame:
+        '''Take CRS charges from the responsibility surcharges, and when a provider or standby takes over,
+        every nonbypassable charge that has a surcharge. Other nonbypassable charges are kept.'''
+        replace_all_nbc = (service_agreement.provider is not None) or (service_agreement.standby is not None)
         merge_cols = ['unit','component']
-        crs_df = crs_rates.extract(service_agreement)
-        crs_df = crs_df[crs_df['type']==crs_type]
-        df.loc[(df['rate']=='CRS')&(df['unit']=='nonbypass'),'rate'] = \
-            df.merge(utility_df,how='left',on=merge_cols,suffixes=['_',''])['rate']
-        return df
-
-    def _get_truth(self,df,season:str,period:str,components:List[str],level:int,crs_type:str) -> pandas.Series:
-        truth_value = df['unit']==unit
-        if ('season' in df.columns) & (season is not None):
-            truth_value = truth_value & ((df['season']==season) if not pandas.isnull(season) else df['season'].isnull())
-        if ('period' in df.columns) & (period is not None):
-            truth_value = truth_value & ((df['period']==period) if not pandas.isnull(period) else df['period'].isnull())
-        if ('component' in df.columns) & (components is not None):
-            truth_value = truth_value & (df['component'].isin(components))
-        if ('level' in df.columns) & (level is not None):
-            truth_value = truth_value & (df['level']==level)
-        if ('crs type' in df.columns) & (crs_type is not None):
-            truth_value = truth_value & (df['crs type']==crs_type)
-        return truth_value
+        surcharged = df[merge_cols].merge(crs_df[merge_cols].drop_duplicates(),how='left',on=merge_cols,
+                                          indicator=True)['_merge'].eq('both').to_numpy()
+        crs = (df['unit']=='nonbypass') & (self._marked(df,'CRS') | (replace_all_nbc & surcharged))
+        replaced = df[crs].drop(columns='value').merge(crs_df[merge_cols+['value']],how='left',on=merge_cols)
+        self._check_replaced(replaced,'CRS',merge_cols)
+        return pandas.concat([df[~crs],replaced],ignore_index=True)
 
 class Rates:
     '''Base class for charges and credits of a specific category'''
     def __init__(self,rates_db:RatesDB,table:str):
         self.utility = rates_db.utility
-        self.table = self.data['{}rates'.format(table)]
+        self.table = rates_db.data['{}rates'.format(table)]
+        self.sources = {}
+        self._extracted = {}
         self._unpivot()
 
+    def add_sources(self,utility_rates=None,crs_rates=None):
+        '''Rates that OAT and CRS charges in extracted schedules are taken from'''
+        self.sources = {'utility_rates':utility_rates,'crs_rates':crs_rates}
+        self._extracted = {}
+
+    def extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
+        '''Schedule for an agreement, extracted once so its resolved charges are kept for the next call'''
+        key = service_agreement.fingerprint()
+        if key not in self._extracted:
+            self._extracted[key] = self._extract(service_agreement)
+        return self._extracted[key]
+
+    def _schedule(self,category:str,df:pandas.DataFrame,**parameters) -> RateSchedule:
+        return RateSchedule(category,df,**self.sources,**parameters)
+
     def _unpivot(self):
         '''Unpivot table based on position of effective date'''
         df = self.table
         df_cols = df.columns.tolist()
         melt_list = df_cols[:df_cols.index('effective')+1]
-        df_melted = df.melt(id_vars=melt_list,var_name='charge')
-        df_melted = df_melted[(df_melted['value']!=0)&
-                                (~df_melted['value'].isnull())]
-        for col in clean_cols:
-            df_melted[col] = df_melted['charge'].apply(something)
+        charge_list = df_cols[df_cols.index('effective')+1:]
+        # keep only charges that are there, in the order melting would give
+        values = df[charge_list].to_numpy()
+        charges,rows = numpy.nonzero(((values!=0) & ~pandas.isnull(values)).T)
+        df_melted = df[melt_list].take(rows).reset_index(drop=True)
+        df_melted['charge'] = pandas.Categorical.from_codes(charges,charge_list)
+        df_melted['value'] = values[rows,charges]
         self.table = df_melted
 
     def _clean(self,columns:List[str]):
+        '''Decode each distinct charge code once and spread the results to every row with that code'''
         f_dict = {'unit':self._clean_unit,
                   'season':self._clean_season,
                   'period':self._clean_period,
                   'component':self._clean_component,
                   'level':self._clean_level,
                   'crs type':self._clean_crs}
-        functions = [f_dict[c] for c in columns]
-        self.table[columns] = self.table['charge'].apply(functions).drop('charge',axis=1)
+        codes,charges = pandas.factorize(self.table['charge'])
+        for column in columns:
+            # rows without a code take the empty value on the end
+            decoded = pandas.Series([f_dict[column](charge) for charge in charges]+[numpy.nan])
+            self.table[column] = decoded.to_numpy()[codes]
 
     def _clean_unit(self,phrase:str) -> str:
         '''Determine base unit'''
@@ -168,7 +398,8 @@ class Rates:
                   'kwh':'energy',
                   'kw':'demand',
                   'nbc':'nonbypass'}
-        decoded = legend.get(phrase,phrase)
+        found = unit_code.search(phrase)
+        decoded = legend[found.group(0)] if found else phrase
         return decoded
 
     def _clean_season(self,phrase:str) -> str:
@@ -178,9 +409,9 @@ class Rates:
                   '3':'spring',
                   '4':'fall'}
         if '-' in phrase:
-            decoded = legend.get(phrase[phrase.index('-')-1],pandas.np.nan)
+            decoded = legend.get(phrase[phrase.index('-')-1],numpy.nan)
         else:
-            decoded = pandas.np.nan
+            decoded = numpy.nan
         return decoded
 
     def _clean_period(self,phrase:str) -> str:
@@ -190,9 +421,9 @@ class Rates:
                   '3':'onpeak',
                   '4':'superoffpeak'}
         if '-' in phrase:
-            decoded = legend.get(phrase[phrase.index('-')+1],pandas.np.nan)
+            decoded = legend.get(phrase[phrase.index('-')+1],numpy.nan)
         else:
-            decoded = pandas.np.nan
+            decoded = numpy.nan
         return decoded
 
     def _clean_component(self,phrase:str) -> str:
@@ -202,24 +433,22 @@ class Rates:
                   't':'bypass',
                   'cr':'credit',
                   'max':'maximum'}
-        decoded = pandas.np.nan
-        for unit in ['kwh','kw','nbc']:
-            if unit in phrase:
-                decoded = legend.get(phrase[phrase.index(unit)+len(unit)+1:],pandas.np.nan)
-                break
+        found = component_code.search(crs_code.sub('',phrase))
+        decoded = legend.get(found.group(1),numpy.nan) if found else numpy.nan
         return decoded
     
     def _clean_level(self,phrase:str) -> str:
         '''Determine level, if applicable'''
-        if 'customer' in phrase:
+        if ('customer' in phrase) and phrase[-1].isdigit():
             decoded = int(phrase[-1])
         else:
-            decoded = pandas.np.nan
+            decoded = numpy.nan
         return decoded
 
     def _clean_crs(self,phrase:str) -> str:
         '''Strip crs type from component'''
-        decoded = None
+        found = crs_code.search(phrase)
+        decoded = found.group(1) if found else numpy.nan
         return decoded
 
 class UtilityRates(Rates):
@@ -228,16 +457,16 @@ class UtilityRates(Rates):
         Rates.__init__(self,rates_db,'utility')
         self._clean(['unit','season','period','component','level'])
 
-    def extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
+    def _extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
         df = self.table[(self.table['subTOU']==service_agreement.subTOU)&
                         (self.table['rate']==service_agreement.rate.name)&
                         (self.table['option']==service_agreement.option)&
                         (self.table['connection']==service_agreement.connection)]
-        return RateSchedule('utility',df,
-                            service_agreement.subTOU,
-                            service_agreement.rate.name,
-                            service_agreement.option,
-                            service_agreement.connection)
+        return self._schedule('utility',df,
+                              subTOU=service_agreement.subTOU,
+                              rate=service_agreement.rate.name,
+                              option=service_agreement.option,
+                              connection=service_agreement.connection)
 
 class StandbyRates(Rates):
     '''Unbundled standby charges and credits'''
@@ -245,9 +474,9 @@ class StandbyRates(Rates):
         Rates.__init__(self,rates_db,'standby')
         self._clean(['unit','season','period','component','level'])
 
-    def extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
-        rate_m = pandas.np.nan
-        option_m = pandas.np.nan
+    def _extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
+        rate_m = numpy.nan
+        option_m = numpy.nan
         if service_agreement.rate.name in self.table['rate'].values:
             rate_m = service_agreement.rate.name
             if service_agreement.option in self.table[self.table['rate']==service_agreement.rate.name]['option'].values:
@@ -257,24 +486,24 @@ class StandbyRates(Rates):
                         ((self.table['rate']==rate_m) if pandas.isnull(rate_m) else (self.table['rate'].isnull()))&
                         ((self.table['option']==option_m) if pandas.isnull(option_m) else (self.table['option'].isnull()))&
                         (self.table['connection']==service_agreement.connection)]
-        return RateSchedule('standby',df,
-                            service_agreement.subTOU,
-                            service_agreement.rate.name,
-                            service_agreement.option,
-                            service_agreement.connection)
+        return self._schedule('standby',df,
+                              subTOU=service_agreement.subTOU,
+                              rate=service_agreement.rate.name,
+                              option=service_agreement.option,
+                              connection=service_agreement.connection)
 
 class CRSRates(Rates):
     '''Alternate generation source surcharges'''
     def __init__(self,rates_db:RatesDB):
         Rates.__init__(self,rates_db,'crs')
-        self.clean(['unit','season','period','component','crs type']) # pcia, xxx da
+        self._clean(['unit','season','period','component','crs type']) # pcia, xxx da
 
-    def extract(self,service_agreement:ServiceAgreement) -> RateSchedule: # no subTOU
+    def _extract(self,service_agreement:ServiceAgreement) -> RateSchedule: # no subTOU
         df = self.table[(self.table['group']==service_agreement.group)&
                         (self.table['vintage']==service_agreement.vintage)]
-        return RateSchedule('crs',df,
-                            group=service_agreement.group,
-                            vintage=service_agreement.vintage)
+        return self._schedule('crs',df,
+                              group=service_agreement.group,
+                              vintage=service_agreement.vintage)
 
 class CCARates(Rates):
     '''Community choice aggregation charges'''
@@ -284,19 +513,19 @@ class CCARates(Rates):
         self._refine_provider()
         self._clean(['unit','season','period','component'])
 
-    def _refine_provider():
+    def _refine_provider(self):
         self.table = self.table[self.table['provider']==self.provider.name].drop('provider',axis=1)
 
-    def extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
+    def _extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
         df = self.table[(self.table['subTOU']==service_agreement.subTOU)&
                         (self.table['rate']==service_agreement.rate.name)&
                         (self.table['option']==service_agreement.option)&
                         (self.table['connection']==service_agreement.connection)]
-        return RateSchedule('cca',df,
-                            subTOU=service_agreement.subTOU,
-                            rate=service_agreement.rate.name,
-                            option=service_agreement.option,
-                            connection=service_agreement.connection)
+        return self._schedule('cca',df,
+                              subTOU=service_agreement.subTOU,
+                              rate=service_agreement.rate.name,
+                              option=service_agreement.option,
+                              connection=service_agreement.connection)
 
 class PKPRates(Rates):
     '''Community choice aggregation charges'''
@@ -304,16 +533,16 @@ class PKPRates(Rates):
         Rates.__init__(self,rates_db,'pkp')
         self._clean(['unit','season','period','component'])
 
-    def extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
+    def _extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
         df = self.table[(self.table['subTOU']==service_agreement.subTOU)&
                         (self.table['rate']==service_agreement.rate.name)&
                         (self.table['option']==service_agreement.option)&
                         (self.table['connection']==service_agreement.connection)]
-        return RateSchedule('pkp',df,
-                            subTOU=service_agreement.subTOU,
-                            rate=service_agreement.rate.name,
-                            option=service_agreement.option,
-                            connection=service_agreement.connection)
+        return self._schedule('pkp',df,
+                              subTOU=service_agreement.subTOU,
+                              rate=service_agreement.rate.name,
+                              option=service_agreement.option,
+                              connection=service_agreement.connection)
 
 class InterruptRates(Rates):
     '''Base interruptible rates'''
@@ -321,16 +550,16 @@ class InterruptRates(Rates):
         Rates.__init__(self,rates_db,'interrupt')
         self._clean(['unit','season','period','component'])
 
-    def extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
+    def _extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
         df = self.table[(self.table['subTOU']==service_agreement.subTOU)&
                         (self.table['incentive']==service_agreement.rate.name)&
                         (self.table['option']==service_agreement.interrupt_option)&
                         (self.table['connection']==service_agreement.connection)]
-        return RateSchedule('interrupt',df,
-                            subTOU=service_agreement.subTOU,
-                            incentive=service_agreement.interrupt_incentive,
-                            option=service_agreement.interrupt_option,
-                            connection=service_agreement.connection)
+        return self._schedule('interrupt',df,
+                              subTOU=service_agreement.subTOU,
+                              incentive=service_agreement.interrupt_incentive,
+                              option=service_agreement.interrupt_option,
+                              connection=service_agreement.connection)
 
 class ShiftRates(Rates):
     '''Power shifting rates'''
@@ -338,14 +567,14 @@ class ShiftRates(Rates):
         Rates.__init__(self,rates_db,'aps')
         self._clean(['unit'])
 
-    def extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
+    def _extract(self,service_agreement:ServiceAgreement) -> RateSchedule:
         df = self.table[(self.table['incentive']==service_agreement.shift_incentive)&
                         (self.table['option']==service_agreement.shift_option)&
                         (self.table['cycling']==service_agreement.cycling)]
-        return RateSchedule('shift',df,
-                            incentive=service_agreement.shift_incentive,
-                            option=service_agreement.shift_option,
-                            cycling=service_agreement.cycling)
+        return self._schedule('shift',df,
+                              incentive=service_agreement.shift_incentive,
+                              option=service_agreement.shift_option,
+                              cycling=service_agreement.cycling)
 
 class GroupsDB:
     '''Tables linking rates, options, standby and connections to S and CRS'''
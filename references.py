@@ -1,7 +1,13 @@
 '''Box files and local references'''
-# local path
+# local path for saved reference tables
 references_p = 'pickles'
 
+# local path for downloaded files
+downloads_p = 'downloads'
+
+# seconds to wait on hosted files
+timeout = 30
+
 # Times and Seasons
 times_and_seasons = 'https://tvrp.box.com/shared/static/5crlb9vmxmiuyt3vartvhysjgs5u36xq.xlsx'
 
@@ -1,35 +1,342 @@
 '''Opening files and pickled varialbes'''
-import fnmatch,pickle,os
+import fnmatch,pickle,os,json,hashlib,shutil,datetime,time,warnings
+import pandas,numpy
+import collections,collections.abc,threading,mmap
+import requests,requests.adapters
 import references
 
+def is_url(file:str) -> bool:
+    '''Check if file is hosted'''
+    return fnmatch.fnmatch(file,'http*:*')
+
+def validators(response:requests.Response) -> dict:
+    '''Cache validators of a hosted file'''
+    return {'etag':response.headers.get('ETag'),
+            'last-modified':response.headers.get('Last-Modified')}
+
+def conditional_headers(known:dict) -> dict:
+    '''Headers that ask a server to skip the body if validators still match'''
+    headers = {}
+    if known.get('etag'):
+        headers['If-None-Match'] = known['etag']
+    if known.get('last-modified'):
+        headers['If-Modified-Since'] = known['last-modified']
+    return headers
+
+def fingerprint(file:str,known:dict=None) -> dict:
+    '''Identify the current contents of a local or hosted file.
+    Known fingerprint is revalidated with a conditional request or a stat before any hashing.'''
+    known = {} if known is None else known
+    if is_url(file):
+        with downloader.session.get(file,headers=conditional_headers(known),stream=True,
+                                    timeout=references.timeout) as r:
+            if r.status_code==304:
+                found = known
+            else:
+                r.raise_for_status()
+                found = validators(r)
+    else:
+        stat = os.stat(file)
+        found = {'mtime':stat.st_mtime,'size':stat.st_size}
+        if (known.get('mtime'),known.get('size'))==(found['mtime'],found['size']):
+            found['sha256'] = known.get('sha256')
+        else:
+            sha = hashlib.sha256()
+            with open(file,'rb') as f:
+                for block in iter(lambda: f.read(1<<20),b''):
+                    sha.update(block)
+            found['sha256'] = sha.hexdigest()
+    return found
+
+def same_source(known:dict,found:dict) -> bool:
+    '''Compare fingerprints, treating a source without validators as changed'''
+    keys = ['sha256'] if 'sha256' in found else ['etag','last-modified']
+    validators = [k for k in keys if found.get(k) is not None]
+    return (len(validators)>0) and all(known.get(k)==found[k] for k in validators)
+
+def fetch(file:str) -> str:
+    '''Return openable local path, downloading file to the cache if hosted'''
+    link = downloader.download(file) if is_url(file) else file
+    return link
+
+def build_variables(variables:str,build,source:str,link=None,found:dict=None) -> float:
+    '''Build a variable from its source, save it and return the seconds spent.
+    Runs in a worker process, so only the file and fingerprint are passed in.'''
+    start = time.perf_counter()
+    vs = VariableSet(variables,source=source)
+    vs._fingerprint = found
+    vs.add(variables,build(source,link))
+    vs.save()
+    return time.perf_counter()-start
+
+class Downloader:
+    '''Pooled downloads streamed in chunks to an on-disk cache.
+    Cached copies are revalidated and interrupted downloads resume with a range request.'''
+    def __init__(self,folder:str=references.downloads_p,pool_size:int=10,chunk_size:int=1<<20,retries:int=3):
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+        self._locks = collections.defaultdict(threading.Lock)
+
+    def cache_name(self,url:str) -> str:
+        '''Local path of cached copy of url'''
+        return '{}/{}'.format(self.folder,hashlib.sha1(url.encode()).hexdigest())
+
+    def download(self,url:str) -> str:
+        '''Bring cached copy of url up to date and return its path'''
+        filename = self.cache_name(url)
+        with self._locks[filename]:
+            os.makedirs(self.folder,exist_ok=True)
+            for attempt in range(self.retries):
+                try:
+                    self._download(url,filename)
+                    break
+                except (requests.ConnectionError,requests.Timeout,requests.exceptions.ChunkedEncodingError):
+                    if attempt==self.retries-1:
+                        raise
+        return filename
+
+    def _download(self,url:str,filename:str):
+        '''Stream url to a partial file, continuing where a previous attempt stopped.
+        Validators of the partial file only replace those of the complete copy once it is complete.'''
+        partial = '{}.part'.format(filename)
+        metaname = '{}.json'.format(filename)
+        partial_metaname = '{}.json'.format(partial)
+        complete = {}
+        if os.path.isfile(metaname):
+            with open(metaname) as f:
+                complete = json.load(f)
+        started = {}
+        if os.path.isfile(partial_metaname):
+            with open(partial_metaname) as f:
+                started = json.load(f)
+        if os.path.isfile(partial) and (started.get('etag') or started.get('last-modified')):
+            # resume only if the file has not changed since the partial copy started
+            headers = {'Range':'bytes={}-'.format(os.path.getsize(partial)),
+                       'If-Range':started.get('etag') or started.get('last-modified')}
+        elif os.path.isfile(filename):
+            # revalidate complete copy
+            headers = conditional_headers(complete)
+        else:
+            headers = {}
+        with self.session.get(url,headers=headers,stream=True,timeout=references.timeout) as r:
+            if r.status_code==304:
+                return
+            r.raise_for_status()
+            if r.status_code!=206:
+                with open(partial_metaname,'w') as f:
+                    json.dump(validators(r),f)
+            with open(partial,'ab' if r.status_code==206 else 'wb') as f:
+                for chunk in r.iter_content(self.chunk_size):
+                    f.write(chunk)
+        os.replace(partial,filename)
+        os.replace(partial_metaname,metaname)
+
+    def open(self,file:str,mapped:bool=False):
+        '''Return seekable file, or read-only memory map, of a local or hosted file'''
+        f = open(fetch(file),'rb')
+        if mapped:
+            with f:
+                f = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        return f
+
+downloader = Downloader()
+
 class OpenFile:
     '''File that can be opened regardless of location'''
     def __init__(self,file):
-        if fnmatch.fnmatch(file,'http*:*'):
-            r = requests.get(file,stream=True)
-            self.link = io.BytesIO(r.content)
+        self.link = fetch(file)
+
+class LazyTables(collections.abc.MutableMapping):
+    '''Dictionary of tables that are only built the first time they are used'''
+    def __init__(self,names,build,build_many=None):
+        self._names = list(names)
+        self._build = build
+        self._build_many = build_many
+        self._built = {}
+
+    def __repr__(self):
+        return 'Tables: {} ({} built)'.format(', '.join(self._names),len(self._built))
+
+    def __getitem__(self,name):
+        if name not in self._built:
+            if name not in self._names:
+                raise KeyError(name)
+            self._built[name] = self._build(name)
+        return self._built[name]
+
+    def __setitem__(self,name,table):
+        if name not in self._names:
+            self._names += [name]
+        self._built[name] = table
+
+    def __delitem__(self,name):
+        self._names.remove(name)
+        self._built.pop(name,None)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self,name):
+        return name in self._names
+
+    def built(self) -> list:
+        '''Names of tables already built'''
+        return list(self._built)
+
+    def build_all(self):
+        '''Build every remaining table, together if possible'''
+        missing = [n for n in self._names if n not in self._built]
+        if len(missing) and (self._build_many is not None):
+            self._built.update(self._build_many(missing))
+        for name in missing:
+            self[name]
+
+class StoredTables:
+    '''Tables saved column by column and memory-mapped the first time each is used'''
+    def __init__(self,folder:str,tables:dict):
+        self.folder = folder
+        self.tables = tables
+        self.data = LazyTables(tables,self._load_table)
+
+    def __repr__(self):
+        return 'Folder: {}\n{}'.format(self.folder,self.data)
+
+    def __getitem__(self,table_name):
+        return self.data[table_name.lower()]
+
+    def _load_table(self,table_name:str) -> pandas.DataFrame:
+        '''Map each column file of a table'''
+        columns = self.tables[table_name]['columns']
+        series = {c['name']: load_column('{}/{}/{}.npy'.format(self.folder,table_name,i),c) for i,c in enumerate(columns)}
+        df = pandas.DataFrame(series,columns=[c['name'] for c in columns],copy=False)
+        return df
+
+def save_tables(folder:str,data:dict) -> dict:
+    '''Write each table to a folder of column files and describe them'''
+    tables = {}
+    for table_name,df in data.items():
+        os.makedirs('{}/{}'.format(folder,table_name))
+        columns = [save_column('{}/{}/{}.npy'.format(folder,table_name,i),df[c]) for i,c in enumerate(df.columns)]
+        for column,name in zip(columns,df.columns):
+            column['name'] = name
+        tables[table_name] = {'rows':len(df),'columns':columns}
+    return tables
+
+def save_column(filename:str,series:pandas.Series) -> dict:
+    '''Write a column as a flat array that can be memory-mapped'''
+    column = {}
+    values = series.dropna()
+    if pandas.api.types.is_datetime64_any_dtype(series):
+        column['kind'] = 'datetime'
+        array = series.to_numpy()
+    elif pandas.api.types.is_bool_dtype(series) or \
+        (pandas.api.types.is_numeric_dtype(series) and not pandas.api.types.is_object_dtype(series)):
+        column['kind'] = 'number'
+        array = series.to_numpy()
+    elif all(isinstance(v,str) for v in values):
+        # dictionary encode strings
+        column['kind'] = 'string'
+        codes,categories = pandas.factorize(series)
+        column['categories'] = categories.tolist()
+        array = codes.astype(numpy.int32)
+    elif all(isinstance(v,datetime.time) for v in values):
+        # microseconds since midnight
+        column['kind'] = 'time'
+        array = numpy.array([-1 if pandas.isnull(v) else \
+            ((v.hour*60+v.minute)*60+v.second)*1000000+v.microsecond for v in series],dtype=numpy.int64)
+    else:
+        column['kind'] = 'object'
+        array = series.to_numpy(dtype=object)
+    numpy.save(filename,array,allow_pickle=column['kind']=='object')
+    return column
+
+def load_column(filename:str,column:dict) -> pandas.Series:
+    '''Read a column, sharing the pages of the file where the type allows'''
+    if column['kind']=='object':
+        series = pandas.Series(numpy.load(filename,allow_pickle=True))
+    else:
+        array = numpy.load(filename,mmap_mode='r')
+        if column['kind']=='string':
+            series = pandas.Series(numpy.array(column['categories']+[None],dtype=object)[array])
+        elif column['kind']=='time':
+            series = pandas.Series([None if v<0 else (datetime.datetime.min+datetime.timedelta(microseconds=int(v))).time() \
+                for v in array],dtype=object)
         else:
-            self.link = file
+            series = pandas.Series(array,copy=False)
+    return series
 
 class VariableSet:
-    def __init__(self,variables,project=None,strict=False):
+    def __init__(self,variables,project=None,strict=False,source=None):
         # reference file or project specific
         self.path = references.references_p if project is None else '{}/variables'.format(project)
+        self.folder = '{}/{}'.format(self.path,variables)
+        self.manifestname = '{}/manifest.json'.format(self.folder)
         self.picklename = '{}/{}.p'.format(self.path,variables)
+        self.source = source
         self._v = {}
         self._strict = strict
+        self._fingerprint = None
 
     def __getitem__(self,variable):
         return self._v.get(variable)
 
     def exists(self):
-        # check if pickle file exists
-        return os.path.isfile(self.picklename)
+        # check if saved manifest, or a whole-object pickle from before column files, exists
+        return os.path.isfile(self.manifestname) or os.path.isfile(self.picklename)
+
+    def manifest(self) -> dict:
+        # description of saved variables
+        with open(self.manifestname) as f:
+            manifest = json.load(f)
+        return manifest
+
+    def saved_fingerprint(self) -> dict:
+        # fingerprint of source when variables were last saved
+        known = self.manifest().get('source',{}) if os.path.isfile(self.manifestname) else {}
+        return known
+
+    def stale(self) -> bool:
+        # check if variables are missing or their source has changed since saved
+        known = self.saved_fingerprint()
+        if self.source is not None:
+            try:
+                self._fingerprint = fingerprint(self.source,known)
+            except (requests.RequestException,OSError) as error:
+                if not self.exists():
+                    raise
+                # keep working from the saved copy while the source can't be reached
+                warnings.warn('Could not revalidate {}, using saved copy: {}'.format(self.source,error))
+                self._fingerprint = known
+                return False
+        if not self.exists():
+            is_stale = True
+        elif self.source is None:
+            is_stale = False
+        else:
+            is_stale = not same_source(known,self._fingerprint)
+        return is_stale
 
     def load(self):
-        # load variables from pickle file
-        with open(self.picklename,'rb') as f:
-            self._v = pickle.load(f)
+        # unpickle old whole-object copy until it is rebuilt as column files
+        if not os.path.isfile(self.manifestname):
+            with open(self.picklename,'rb') as f:
+                self._v = pickle.load(f)
+            return
+        # map tables and unpickle anything else
+        for name,entry in self.manifest()['variables'].items():
+            if entry['kind']=='tables':
+                self._v[name] = StoredTables('{}/{}'.format(self.folder,name),entry['tables'])
+            else:
+                with open('{}/{}.p'.format(self.folder,name),'rb') as f:
+                    self._v[name] = pickle.load(f)
 
     def extract(self):
         # return loaded variables
@@ -45,7 +352,32 @@ class VariableSet:
         # create needed directory
         if (not os.path.exists(self.path)) and (not self._strict):
             os.makedirs(self.path)
-        # save pickle file
         if len(self._v)>0:
-            with open(self.picklename,'wb') as f:
-                pickle.dump(self._v,f)
\ No newline at end of file
+            # write next to current copy so readers never see a partial save
+            staging = '{}.tmp'.format(self.folder)
+            if os.path.exists(staging):
+                shutil.rmtree(staging)
+            os.makedirs(staging)
+            manifest = {'variables':{}}
+            for name,variable in self._v.items():
+                data = getattr(variable,'data',None)
+                if isinstance(data,collections.abc.Mapping):
+                    # save tables column by column
+                    if isinstance(data,LazyTables):
+                        data.build_all()
+                    manifest['variables'][name] = {'kind':'tables',
+                                                   'tables':save_tables('{}/{}'.format(staging,name),data)}
+                else:
+                    with open('{}/{}.p'.format(staging,name),'wb') as f:
+                        pickle.dump(variable,f)
+                    manifest['variables'][name] = {'kind':'pickle'}
+            # record source that variables were built from
+            if self.source is not None:
+                if self._fingerprint is None:
+                    self._fingerprint = fingerprint(self.source)
+                manifest['source'] = self._fingerprint
+            with open('{}/manifest.json'.format(staging),'w') as f:
+                json.dump(manifest,f)
+            if os.path.exists(self.folder):
+                shutil.rmtree(self.folder)
+            os.rename(staging,self.folder)
\ No newline at end of file
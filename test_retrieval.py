@@ -0,0 +1,98 @@
+'''Downloads against a local server that can change a file and cut responses short'''
+import unittest,threading,tempfile,shutil,os,json
+import http.server
+import requests
+import retrieval
+
+class Hosted:
+    '''File served by the local server, with the number of responses to cut short'''
+    body = b''
+    etag = ''
+    cuts = 0
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self,*args):
+        pass
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match')==Hosted.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = Hosted.body
+        first = 0
+        if self.headers.get('Range') and self.headers.get('If-Range')==Hosted.etag:
+            first = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range','bytes {}-{}/{}'.format(first,len(body)-1,len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag',Hosted.etag)
+        self.send_header('Content-Length',str(len(body)-first))
+        self.end_headers()
+        if Hosted.cuts:
+            # send half of what is left and drop the connection
+            Hosted.cuts -= 1
+            self.wfile.write(body[first:first+(len(body)-first)//2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body[first:])
+
+def host(version:str,cuts:int=0):
+    Hosted.body = version.encode()*10000
+    Hosted.etag = '"{}"'.format(version)
+    Hosted.cuts = cuts
+
+class TestDownloader(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1',0),Handler)
+        threading.Thread(target=cls.server.serve_forever,daemon=True).start()
+        cls.url = 'http://127.0.0.1:{}/rates.xlsx'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.downloader = retrieval.Downloader(self.folder,retries=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def cached(self) -> tuple:
+        filename = self.downloader.cache_name(self.url)
+        with open(filename,'rb') as f:
+            body = f.read()
+        with open('{}.json'.format(filename)) as f:
+            etag = json.load(f)['etag']
+        return body,etag
+
+    def test_unchanged(self):
+        host('v1')
+        self.downloader.download(self.url)
+        self.downloader.download(self.url)
+        self.assertEqual(self.cached(),(Hosted.body,'"v1"'))
+
+    def test_resume(self):
+        host('v1',cuts=1)
+        self.downloader.download(self.url)
+        self.assertEqual(self.cached(),(Hosted.body,'"v1"'))
+
+    def test_interrupted_refresh(self):
+        host('v1')
+        self.downloader.download(self.url)
+        host('v2',cuts=2)
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            self.downloader.download(self.url)
+        # complete copy keeps the validators it was downloaded with
+        self.assertEqual(self.cached(),(b'v1'*10000,'"v1"'))
+        host('v2')
+        self.downloader.download(self.url)
+        self.assertEqual(self.cached(),(Hosted.body,'"v2"'))
+        self.assertFalse(os.path.exists('{}.part'.format(self.downloader.cache_name(self.url))))
+
+if __name__=='__main__':
+    unittest.main()
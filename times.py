@@ -1,33 +1,129 @@
 '''Classify seasons and periods'''
-import pandas,datetime
-import org,xltable
+import pandas,numpy,datetime,collections
+import org,xltable,retrieval
 from typing import List
+from typing import Tuple
+
+# nanoseconds in an hour and a day and days of week as numbered by pandas
+ns_per_hour = 60*60*10**9
+ns_per_day = 24*ns_per_hour
+weekdays = ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
+
+# bits of daily calendar flags
+holiday_bit = 1
+dayoff_bit = 2
+
+def us_dst_days(years:numpy.ndarray) -> Tuple[numpy.ndarray]:
+    '''Second Sunday in March and first Sunday in November of each year, as epoch days'''
+    years = numpy.asarray(years)-1970
+    march = (years*12+2).astype('datetime64[M]').astype('datetime64[D]').view(numpy.int64)
+    november = (years*12+10).astype('datetime64[M]').astype('datetime64[D]').view(numpy.int64)
+    return march+(6-(march+3)%7)+7,november+(6-(november+3)%7)
+
+class Calendar:
+    '''Day, month, day of year, day of week and slot of day of each point on a grid, as small integers.
+    Shared by every meter on the same grid, so the arrays are read-only.'''
+    def __init__(self,start:int,frequency:int,length:int):
+        self.start = start
+        self.frequency = frequency
+        ns = start+frequency*numpy.arange(length,dtype=numpy.int64)
+        days = ns//ns_per_day
+        self.days = days.astype(numpy.int32)
+        self.month = (ns.view('datetime64[ns]').astype('datetime64[M]').view(numpy.int64)%12+1).astype(numpy.int8)
+        self.dayofyear = (days-ns.view('datetime64[ns]').astype('datetime64[Y]').astype('datetime64[D]').view(numpy.int64)+1
+                          ).astype(numpy.int16)
+        self.dayofweek = ((days+3)%7).astype(numpy.int8)
+        self.minute = ((ns-days*ns_per_day)//(60*10**9)).astype(numpy.int16)
+        self.slot = ((ns-days*ns_per_day)//frequency).astype(numpy.int16)
+        for array in [self.days,self.month,self.dayofyear,self.dayofweek,self.minute,self.slot]:
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self.days)
+
+    def __getitem__(self,span:slice):
+        '''Calendar of part of the grid, sharing the arrays'''
+        calendar = Calendar.__new__(Calendar)
+        first = range(len(self))[span].start if len(range(len(self))[span]) else 0
+        calendar.start = self.start+self.frequency*first
+        calendar.frequency = self.frequency
+        for attribute in ['days','month','dayofyear','dayofweek','minute','slot']:
+            setattr(calendar,attribute,getattr(self,attribute)[span])
+        return calendar
+
+    @property
+    def ns(self) -> numpy.ndarray:
+        '''Epoch nanoseconds of each point'''
+        return self.start+self.frequency*numpy.arange(len(self),dtype=numpy.int64)
+
+# calendars by (start, frequency, length), least recently used first
+_calendars = collections.OrderedDict()
+calendar_cache_size = 64
+
+def calendar(start:int,frequency:int,length:int) -> Calendar:
+    '''Calendar of a grid, built once and shared'''
+    key = (int(start),int(frequency),int(length))
+    if key in _calendars:
+        _calendars.move_to_end(key)
+    else:
+        _calendars[key] = Calendar(*key)
+        if len(_calendars)>calendar_cache_size:
+            _calendars.popitem(last=False)
+    return _calendars[key]
 
 class TOUdb:
-    def __init__(self,tables,utility):
+    def __init__(self,tables,utility,cache_size:int=32):
+        self._compiled = collections.OrderedDict()
+        self.cache_size = cache_size
         self.utility = utility
-        self.data = tables.data
-        self._refine()
+        self.tables = tables.data
+        self.data = retrieval.LazyTables(self.tables,self._refine)
 
     def __getattr__(self,attribute):
         return self.data.get(attribute)
 
-    def _refine(self):
-        for tbl in self.data:
-            df = self.data[tbl]
-            if 'utility' in df.columns:
-                self.data[tbl] = df[df['utility']==self.utility.name].drop('utility',axis=1)
+    def __getitem__(self,table):
+        return self.data[table]
+
+    def _refine(self,tbl:str) -> pandas.DataFrame:
+        df = self.tables[tbl]
+        if 'utility' in df.columns:
+            df = df[df['utility']==self.utility.name].drop('utility',axis=1)
+        return df
+
+    def _key(self,subTOU,schedule) -> Tuple[str]:
+        # blank schedule is the default for the subTOU
+        return (subTOU,None if (not schedule) or pandas.isnull(schedule) else schedule)
 
     def extract(self,subTOU,schedule):
-        tables = ['seasons','periods','daysoff','holidays','dstadj']
+        # reuse compiled TOU, keeping only the most recently used
+        key = self._key(subTOU,schedule)
+        if key in self._compiled:
+            self._compiled.move_to_end(key)
+        else:
+            self._compiled[key] = self._extract(*key)
+            self._compiled[key].compile()
+            if len(self._compiled)>self.cache_size:
+                self._compiled.popitem(last=False)
+        return self._compiled[key]
+
+    def extract_many(self,keys:List[Tuple[str]]):
+        # one TOU per (subTOU, schedule), compiled once for each distinct pair
+        keys = [self._key(*key) for key in keys]
+        compiled = {key: self.extract(*key) for key in dict.fromkeys(keys)}
+        return [compiled[key] for key in keys]
+
+    def _extract(self,subTOU,schedule):
+        # workbook table behind each part of a TOU
+        tables = {'seasons':'seasons','periods':'tou','daysoff':'daysoff','holidays':'holidays','dstadj':'dst'}
         extracted = {}
         for table in tables:
-            tbl = self[table]
+            tbl = self[tables[table]]
             truth = tbl[tbl.columns[0]]==tbl[tbl.columns[0]]
             if 'subTOU' in tbl.columns:
                 truth = truth & (tbl['subTOU']==subTOU)
                 if 'schedule' in tbl.columns:
-                    truth = truth & (tbl['schedule']==schedule)
+                    truth = truth & ((tbl['schedule']==schedule) if schedule is not None else tbl['schedule'].isnull())
             extracted[table] = tbl[truth]
 
         tou = TOU(subTOU,schedule,seasons=extracted['seasons'],periods=extracted['periods'],
@@ -35,13 +131,130 @@ class TOUdb:
         return tou
 
 class TOU:
+    '''Seasons, periods and days off of one schedule, compiled to lookup arrays'''
+    slot_minutes = 15
+
     def __init__(self,subTOU,schedule,**tables):
         self.subTOU = subTOU
         self.schedule = schedule
         self.tables = tables
+        self.compiled = False
+        self._years = {}
+        self._dst = {}
     def __getattr__(self,attribute):
+        if attribute.startswith('__') or attribute=='tables':
+            # not a table, and tables may not be set yet while unpickling
+            raise AttributeError(attribute)
         return self.tables.get(attribute)
 
+    def compile(self):
+        '''Build season by month, period by (season, dayoff, slot of day) and days off by weekday'''
+        seasons = self.tables['seasons'].sort_values('start')
+        periods = self.tables['periods'].sort_values('start')
+        self.season_names = numpy.array(list(pandas.unique(seasons['season'])),dtype=object)
+        self.period_names = numpy.array(list(pandas.unique(periods['period'])),dtype=object)
+        season_codes = {s: i for i,s in enumerate(self.season_names)}
+        period_codes = {p: i for i,p in enumerate(self.period_names)}
+
+        # each season runs from its start month until the next one starts
+        self.season_lookup = numpy.full(13,-1,dtype=numpy.int8)
+        for start,season in zip(seasons['start'],seasons['season']):
+            self.season_lookup[int(start):] = season_codes[season]
+        if len(seasons):
+            # months before the first start carry over from the end of the year
+            self.season_lookup[:int(seasons['start'].iloc[0])] = season_codes[seasons['season'].iloc[-1]]
+
+        # each period runs from its start time until the next one starts
+        slots = 24*60//self.slot_minutes
+        self.period_lookup = numpy.full((len(self.season_names),2,slots),-1,dtype=numpy.int8)
+        for season,dayoff,start,period in zip(periods['season'],periods['dayoff'],periods['start'],periods['period']):
+            if season in season_codes:
+                slot = (start.hour*60+start.minute)//self.slot_minutes
+                self.period_lookup[season_codes[season],int(dayoff),slot:] = period_codes[period]
+        # slots before the first start carry over from the end of the day
+        for lookup in self.period_lookup.reshape(-1,slots):
+            if (lookup[0]<0) and (lookup>=0).any():
+                lookup[:numpy.argmax(lookup>=0)] = lookup[-1]
+
+        daysoff = self.tables['daysoff']
+        if len(daysoff):
+            self.weekdays_off = daysoff.iloc[0][weekdays].to_numpy(dtype=bool)
+            self.holidays_off = bool(daysoff.iloc[0]['holiday'])
+        else:
+            self.weekdays_off = numpy.zeros(7,dtype=bool)
+            self.holidays_off = False
+        self.holiday_days = numpy.sort(pandas.to_datetime(self.tables['holidays']['date']).to_numpy(dtype='datetime64[D]').astype(numpy.int64))
+
+        # daylight saving bounds by year, in local standard time
+        dstadj = self.tables['dstadj']
+        if (dstadj is not None) and len(dstadj):
+            starts = pandas.to_datetime(dstadj['start']).to_numpy(dtype='datetime64[ns]').view(numpy.int64)
+            ends = pandas.to_datetime(dstadj['end']).to_numpy(dtype='datetime64[ns]').view(numpy.int64)-ns_per_hour
+            self._dst = {int(year): (start,end) for year,start,end in zip(dstadj['year'],starts,ends)}
+        self.compiled = True
+
+    def _day_flags(self,year:int) -> numpy.ndarray:
+        '''Holiday and day-off bits for each day of a year, built once per year'''
+        if year not in self._years:
+            days = numpy.arange(numpy.datetime64('{}-01-01'.format(year),'D'),
+                                numpy.datetime64('{}-01-01'.format(year+1),'D')).view(numpy.int64)
+            holiday = numpy.isin(days,self.holiday_days)
+            dayoff = self.weekdays_off[(days+3)%7] | (holiday & self.holidays_off)
+            self._years[year] = (holiday*holiday_bit | dayoff*dayoff_bit).astype(numpy.uint8)
+        return self._years[year]
+
+    def day_flags(self,first_day:int,last_day:int) -> Tuple[numpy.ndarray,int]:
+        '''Holiday and day-off bits for every day of the years spanned and the day they start from'''
+        first_year,last_year = numpy.array([first_day,last_day]).astype('datetime64[D]').astype('datetime64[Y]').view(numpy.int64)+1970
+        flags = numpy.concatenate([self._day_flags(year) for year in range(first_year,last_year+1)])
+        return flags,int(numpy.datetime64('{}-01-01'.format(first_year),'D').view(numpy.int64))
+
+    def _dst_bounds(self,year:int) -> Tuple[int]:
+        '''Start and end of daylight saving in standard time, using US rules for years not in table'''
+        if year not in self._dst:
+            # second Sunday in March and first Sunday in November at 2am
+            start,end = us_dst_days(year)
+            self._dst[year] = (int(start)*ns_per_day+2*ns_per_hour,int(end)*ns_per_day+ns_per_hour)
+        return self._dst[year]
+
+    def dst_shift(self,ns:numpy.ndarray) -> numpy.ndarray:
+        '''Nanoseconds to add to standard time timestamps to get local prevailing time'''
+        years = ns.view('datetime64[ns]').astype('datetime64[Y]').view(numpy.int64)+1970
+        bounds = numpy.array([self._dst_bounds(year) for year in range(years.min(),years.max()+1)],
+                             dtype=numpy.int64).reshape(-1,2)
+        found = numpy.searchsorted(bounds[:,0],ns,side='right')-1
+        in_dst = (found>=0) & (ns<bounds[found.clip(0),1])
+        return in_dst*ns_per_hour
+
+    def classify(self,timestamps:pandas.DatetimeIndex,standard_time:bool=False) -> Tuple[numpy.ndarray]:
+        '''Return season and period codes for each timestamp, or each point of a calendar.
+        Timestamps recorded without daylight saving are shifted before lookup.'''
+        if not self.compiled:
+            self.compile()
+        if len(timestamps)==0:
+            return numpy.zeros(0,numpy.int8),numpy.zeros(0,numpy.int8)
+        if isinstance(timestamps,Calendar) and not standard_time:
+            days = timestamps.days
+            slots = timestamps.minute//self.slot_minutes
+            months = timestamps.month
+        else:
+            ns = timestamps.ns if isinstance(timestamps,Calendar) else \
+                numpy.asarray(timestamps,dtype='datetime64[ns]').view(numpy.int64)
+            if standard_time:
+                ns = ns + self.dst_shift(ns)
+            days = ns//ns_per_day
+            slots = (ns-days*ns_per_day)//(self.slot_minutes*60*10**9)
+            months = ns.view('datetime64[ns]').astype('datetime64[M]').view(numpy.int64)%12+1
+        flags,first_day = self.day_flags(int(days.min()),int(days.max()))
+        dayoff = (flags[days-first_day] & dayoff_bit)>0
+        seasons = self.season_lookup[months]
+        periods = self.period_lookup[seasons,dayoff.astype(numpy.int8),slots]
+        return seasons,periods
+
+    def labels(self,seasons:numpy.ndarray,periods:numpy.ndarray) -> Tuple[numpy.ndarray]:
+        '''Translate season and period codes to names'''
+        return self.season_names[seasons],self.period_names[periods]
+
 class EventsDB:
     def __init__(self,tables:xltable.RawXL,utility:org.IOU):
         self.utility = utility.org
@@ -52,30 +265,75 @@ class EventsDB:
         return
 
 class Events:
+    '''Non-overlapping events held as sorted start and end arrays for searchsorted lookup'''
     def __init__(self,event_type:str,events:pandas.DataFrame):
         self.event_type = event_type
-        self.events = events
+        self.events = events.sort_values('start').reset_index(drop=True)
+        self._index()
+
+    def __repr__(self):
+        return str(self.events)
+
+    def _index(self):
+        '''Refresh start and end arrays from events'''
+        self.starts = self._to_ns(self.events['start'])
+        self.ends = self._to_ns(self.events['end'])
+
+    def _to_ns(self,times) -> numpy.ndarray:
+        return numpy.asarray(pandas.to_datetime(times),dtype='datetime64[ns]').view(numpy.int64)
+
     def add_historical_events(self,new_events:pandas.DataFrame):
-        self.events = pandas.concat([self.events,new_events]).first()
+        '''Insert events in order, keeping existing events that start at the same time'''
+        new_events = new_events.sort_values('start')
+        new_starts = self._to_ns(new_events['start'])
+        positions = numpy.searchsorted(self.starts,new_starts)
+        is_new = self.starts[positions.clip(max=len(self.starts)-1)]!=new_starts if len(self.starts) else \
+            numpy.ones(len(new_starts),dtype=bool)
+        is_new[1:] &= new_starts[1:]!=new_starts[:-1]
+        order = numpy.argsort(numpy.concatenate([numpy.arange(len(self.events)),
+                                                 positions[is_new]-1+(numpy.arange(is_new.sum())+1)/(is_new.sum()+1)]),
+                              kind='stable')
+        self.events = pandas.concat([self.events,new_events[is_new]],ignore_index=True).iloc[order].reset_index(drop=True)
+        self._index()
+
+    def overlapping(self,start:datetime.datetime,end:datetime.datetime) -> slice:
+        '''Positions of events that overlap a timespan'''
+        first = numpy.searchsorted(self.ends,self._to_ns([start])[0],side='right')
+        last = numpy.searchsorted(self.starts,self._to_ns([end])[0],side='left')
+        return slice(first,max(first,last))
+
+    def flag(self,timestamps:pandas.DatetimeIndex) -> numpy.ndarray:
+        '''Position of the event each timestamp falls in, or -1'''
+        ns = self._to_ns(timestamps)
+        found = numpy.searchsorted(self.starts,ns,side='right')-1
+        inside = (found>=0) & (ns<self.ends[found.clip(0)]) if len(self.starts) else numpy.zeros(len(ns),dtype=bool)
+        return numpy.where(inside,found,-1)
+
     def extract(self,span:List[datetime.datetime]) -> pandas.DataFrame:
-        max_time = self.events.index.max()
+        '''Events during span, projecting past the last known event if needed'''
+        events = self
         max_needed = max(span)
-        if max_needed > max_time:
-            projected_events = _project(self,[max_time,max_needed])
+        if len(self.events) and (pandas.Timestamp(max_needed)>self.events['end'].max()):
+            projected_events = self._project([self.events['end'].max(),max_needed])
+            events = Events(self.event_type,pandas.concat([self.events.assign(projected=False),
+                                                           projected_events.assign(projected=True)],ignore_index=True))
+        return events.events.iloc[events.overlapping(min(span),max_needed)]
+
     def _project(self,span:List[datetime.datetime]) -> pandas.DataFrame:
-        # write rules for determining next periods
-        return None
+        '''Repeat the last year of events in whole weeks, so each lands on the same weekday near the same date'''
+        last_end = self._to_ns([span[0]])[0]
+        template = self.events[self.starts>=last_end-365*ns_per_day]
+        years = numpy.arange(1,int((self._to_ns([span[1]])[0]-last_end)//(365*ns_per_day))+2)
+        shifts = numpy.round(years*365.2425/7).astype(numpy.int64)*7*ns_per_day
+        starts = (self._to_ns(template['start'])[None,:]+shifts[:,None]).ravel()
+        ends = (self._to_ns(template['end'])[None,:]+shifts[:,None]).ravel()
+        projected = pandas.DataFrame({'start':starts.view('datetime64[ns]'),'end':ends.view('datetime64[ns]')})
+        return projected[(starts>last_end)&(starts<=self._to_ns([span[1]])[0])]
 
 class PKPEvents(Events):
     def __init__(self,events:pandas.DataFrame):
         Events.__init__(self,'pkp',events)
-    def _project(self,span:List[datetime.datetime]) -> pandas.DataFrame:
-        # write rules for determining next periods
-        return None
 
 class InterruptEvents(Events):
     def __init__(self,events:pandas.DataFrame):
-        Events.__init__(self,'interrupt',events)
-    def _project(self,span:List[datetime.datetime]) -> pandas.DataFrame:
-        # write rules for determining next periods
-        return None
\ No newline at end of file
+        Events.__init__(self,'interrupt',events)
\ No newline at end of file
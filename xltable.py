@@ -1,21 +1,34 @@
 '''Import data from named Table in local or hosted Excel file to pandas dataframe'''
-import pandas,zipfile,fnmatch
-import requests,io
+import pandas,zipfile,posixpath,datetime,re
+import retrieval
 from typing import List
 from typing import Tuple
 from xml.etree import ElementTree
 
+# OOXML namespaces
+ns_main = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+ns_rel = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+ns_pkg = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# built-in number formats that hold dates and times
+date_formats = set(range(14,18)) | {22} | set(range(27,37)) | set(range(50,59))
+time_formats = set(range(18,22)) | set(range(45,48))
+
 class RawXL:
-    def __init__(self,file:str):
-        '''Intialize object'''
+    def __init__(self,file:str,link=None):
+        '''Intialize object, optionally from an already downloaded copy of file'''
         self.file = file
         self.tables = {}
         self.sheetnames = []
-        self._find_link()
+        self._strings = None
+        self._styles = None
+        self._find_link(link)
         self._unzip()
+        self._get_sheet_info()
         self._get_table_info()
-        self._read_tables()
         self._name_sheets()
+        self.data = retrieval.LazyTables([self.tables[t]['name'].lower() for t in self.tables],
+                                         self._read_table,self._read_tables)
 
     def __repr__(self):
         '''Print raw info'''
@@ -31,93 +44,208 @@ class RawXL:
         df = self.data[table_name.lower()]
         return df
 
-    def _find_link(self):
+    def __getstate__(self):
+        '''Leave out open zip file when pickling'''
+        state = self.__dict__.copy()
+        state['xl'] = None
+        return state
+
+    def __setstate__(self,state):
+        '''Reopen zip file after unpickling'''
+        self.__dict__.update(state)
+        self._unzip()
+
+    def _find_link(self,link=None):
         '''Return openable file'''
-        if fnmatch.fnmatch(self.file,'http*:*'):
-            r = requests.get(self.file,stream=True)
-            self.link = io.BytesIO(r.content)
-        else:
-            self.link = self.file
+        self.link = retrieval.fetch(self.file) if link is None else link
 
     def _unzip(self):
         '''Pull from local file or web and read as zip file'''
         self.xl = zipfile.ZipFile(self.link)
 
+    def _iterparse(self,member:str,tag:str):
+        '''Stream elements of one type from a file in the zip'''
+        with self.xl.open(member) as f:
+            for _,element in ElementTree.iterparse(f):
+                if element.tag==ns_main+tag:
+                    yield element
+                    element.clear()
+
+    def _get_relationships(self,member:str) -> dict:
+        '''Map relationship ids to zip paths for a part'''
+        folder,name = posixpath.split(member)
+        rels = posixpath.join(folder,'_rels',name+'.rels')
+        relationships = {}
+        if rels in self.xl.namelist():
+            for relationship in ElementTree.parse(self.xl.open(rels)).getroot().iter(ns_pkg+'Relationship'):
+                target = relationship.get('Target')
+                target = target[1:] if target.startswith('/') else posixpath.normpath(posixpath.join(folder,target))
+                relationships[relationship.get('Id')] = (relationship.get('Type').split('/')[-1],target)
+        return relationships
+
+    def _get_sheet_info(self):
+        '''Get sheet names and their files in workbook order'''
+        workbook = 'xl/workbook.xml'
+        relationships = self._get_relationships(workbook)
+        root = ElementTree.parse(self.xl.open(workbook)).getroot()
+        properties = root.find(ns_main+'workbookPr')
+        self.epoch = datetime.datetime(1904,1,1) if (properties is not None) and \
+            (properties.get('date1904') in ['1','true']) else datetime.datetime(1899,12,30)
+        self.sheetnames = []
+        self.sheetfiles = []
+        for sheet in root.iter(ns_main+'sheet'):
+            self.sheetnames += [sheet.get('name')]
+            self.sheetfiles += [relationships[sheet.get(ns_rel+'id')][1]]
+
     def _get_table_info(self):
-        '''Get all files in zip of Excel file'''
-        namelist = self.xl.namelist()
-        # get all tables
-        table_list = fnmatch.filter(namelist,'xl/tables/*.xml') # tables/table*.xml
-        # get all sheet relationships
-        sheet_list = fnmatch.filter(namelist,'xl/worksheets/_rels/*.xml.rels')
-        # set up matching
+        '''Get name, range and header of every table and the sheet it sits on'''
         tables = {}
-        for table in table_list:
-            root = ElementTree.parse(self.xl.open(table)).getroot()
-            # assign name and range to table id
-            tables[self._strip_table(table,'xml')] = {attribute: root.get(attribute) for attribute in ['name','ref']}
-        for sheet in sheet_list:
-            # get all relationships and keep sheet info
-            relationships = ElementTree.parse(self.xl.open(sheet)).findall('*')
-            for relationship in relationships:
-                items = relationship.items()
-                found = False
-                for item in items:
-                    for i in item:
-                        if fnmatch.fnmatch(i,'*table*.xml'):
-                            found = True
-                            tables[self._strip_table(i,'rels')]['sheet'] = self._strip_sheet(sheet)
-                            break
-                    if found:
-                        break
+        for sheetnum,sheetfile in enumerate(self.sheetfiles):
+            for rel_type,target in self._get_relationships(sheetfile).values():
+                if rel_type=='table':
+                    root = ElementTree.parse(self.xl.open(target)).getroot()
+                    table = {attribute: root.get(attribute) for attribute in ['name','ref']}
+                    table['header'] = int(root.get('headerRowCount','1'))
+                    table['totals'] = int(root.get('totalsRowCount','0'))
+                    table['columns'] = [c.get('name') for c in root.iter(ns_main+'tableColumn')]
+                    table['sheet'] = sheetnum
+                    tables[int(root.get('id'))] = table
         self.tables = tables
 
-    def _strip_table(self,table_name:str,source:str) -> int:
-        '''Get table number from XML data'''
-        if source=='xml':
-            strip_part = 'xl'
-        elif source=='rels':
-            strip_part = '..'
-        stripped = int(table_name.replace('{}/tables/table'.format(strip_part),'').replace('.xml',''))
-        return stripped
-
-    def _strip_sheet(self,sheet_name:str) -> int:
-        '''Get sheet number from XML data (0-indexed)'''
-        stripped = int(sheet_name.replace('xl/worksheets/_rels/sheet','').replace('.xml.rels',''))-1
-        return stripped
-
-    def _read_tables(self):
-        '''Read each named table to a dictionary of dataframes'''
-        xl_file = pandas.ExcelFile(self.file)
-        self.sheetnames = xl_file.sheet_names
+    def _get_shared_strings(self) -> List[str]:
+        '''Stream the shared string table'''
+        strings = []
+        if 'xl/sharedStrings.xml' in self.xl.namelist():
+            for si in self._iterparse('xl/sharedStrings.xml','si'):
+                strings += [''.join(t.text or '' for t in si.iter(ns_main+'t'))]
+        return strings
+
+    def _get_styles(self) -> List[str]:
+        '''Classify each cell style as date, time or plain number'''
+        styles = []
+        if 'xl/styles.xml' in self.xl.namelist():
+            root = ElementTree.parse(self.xl.open('xl/styles.xml')).getroot()
+            custom = {int(f.get('numFmtId')): self._classify_format(f.get('formatCode')) \
+                for f in root.iter(ns_main+'numFmt')}
+            cell_formats = root.find(ns_main+'cellXfs')
+            for xf in ([] if cell_formats is None else cell_formats.findall(ns_main+'xf')):
+                format_id = int(xf.get('numFmtId','0'))
+                if format_id in custom:
+                    styles += [custom[format_id]]
+                elif format_id in date_formats:
+                    styles += ['date']
+                elif format_id in time_formats:
+                    styles += ['time']
+                else:
+                    styles += [None]
+        return styles
 
+    def _classify_format(self,code:str) -> str:
+        '''Determine if a custom number format displays a date or time'''
+        stripped = re.sub(r'"[^"]*"|\\.|\[[^\]]*\]','',code).lower()
+        if any(c in stripped for c in 'dy') or ('m' in stripped and 'h' not in stripped and 's' not in stripped):
+            style = 'date'
+        elif any(c in stripped for c in 'hs'):
+            style = 'time'
+        else:
+            style = None
+        return style
+
+    def _read_table(self,table_name:str) -> pandas.DataFrame:
+        '''Read one named table'''
+        df = self._read_tables([table_name])[table_name]
+        return df
+
+    def _read_tables(self,table_names:List[str]) -> dict:
+        '''Read named tables to a dictionary of dataframes in one pass over each sheet they are on'''
+        if self._strings is None:
+            self._strings = self._get_shared_strings()
+            self._styles = self._get_styles()
+        strings = self._strings
+        styles = self._styles
+
+        wanted = [t for t in self.tables if self.tables[t]['name'].lower() in table_names]
         dataframes = {}
-        for table in self.tables:
-            xl_range = self.tables[table]['ref']
-            sheetnum = self.tables[table]['sheet']
-            parse_c,skip_r,height = self.split_range(xl_range)
-            df = xl_file.parse(sheetname=sheetnum,skiprows=skip_r,parse_cols=parse_c).iloc[0:height]
-            dataframes[self.tables[table]['name'].lower()] = df
-        self.data = dataframes
+        for sheetnum,sheetfile in enumerate(self.sheetfiles):
+            spans = {t: self._split_range(self.tables[t]['ref']) for t in wanted if self.tables[t]['sheet']==sheetnum}
+            if len(spans)==0:
+                continue
+            grids = {t: [[None]*(spans[t][2]-spans[t][0]+1) for _ in range(spans[t][3]-spans[t][1]+1)] for t in spans}
+            last_row = max(spans[t][3] for t in spans)
+            rownum = 0
+            for row in self._iterparse(sheetfile,'row'):
+                rownum = int(row.get('r')) if row.get('r') else rownum+1
+                in_rows = [t for t in spans if spans[t][1]<=rownum<=spans[t][3]]
+                if len(in_rows):
+                    colnum = 0
+                    for cell in row.iter(ns_main+'c'):
+                        colnum = self._column_number(cell.get('r')) if cell.get('r') else colnum+1
+                        for t in in_rows:
+                            if spans[t][0]<=colnum<=spans[t][2]:
+                                grids[t][rownum-spans[t][1]][colnum-spans[t][0]] = self._cell_value(cell,strings,styles)
+                if rownum>=last_row:
+                    break
+            for t in spans:
+                dataframes[self.tables[t]['name'].lower()] = self._make_frame(self.tables[t],grids[t])
+        return dataframes
+
+    def _cell_value(self,cell:ElementTree.Element,strings:List[str],styles:List[str]):
+        '''Convert a cell to its Python value'''
+        cell_type = cell.get('t','n')
+        if cell_type=='inlineStr':
+            value = ''.join(t.text or '' for t in cell.iter(ns_main+'t'))
+        else:
+            text = cell.findtext(ns_main+'v')
+            if text is None or cell_type=='e':
+                value = None
+            elif cell_type=='s':
+                value = strings[int(text)]
+            elif cell_type=='str':
+                value = text
+            elif cell_type=='b':
+                value = text=='1'
+            else:
+                number = float(text)
+                style = styles[int(cell.get('s','0'))] if len(styles) else None
+                if style=='date':
+                    value = self.epoch + datetime.timedelta(milliseconds=round(number*86400000))
+                elif style=='time':
+                    value = (datetime.datetime.min + datetime.timedelta(milliseconds=round(number%1*86400000))).time()
+                else:
+                    value = int(number) if number.is_integer() else number
+        return value
+
+    def _make_frame(self,table:dict,grid:List[list]) -> pandas.DataFrame:
+        '''Turn a grid of cell values into a table'''
+        rows = grid[table['header']:len(grid)-table['totals']]
+        columns = table['columns'] if len(table['columns'])==len(grid[0]) else \
+            (grid[0] if table['header'] else list(range(len(grid[0]))))
+        df = pandas.DataFrame({c: pandas.Series([float('nan') if row[i] is None else row[i] for row in rows]) \
+            for i,c in enumerate(columns)},columns=columns)
+        return df
+
+    def _column_number(self,reference:str) -> int:
+        '''Translate Excel column letters of a cell reference to a number'''
+        number = 0
+        for s in reference:
+            if s.isdigit():
+                break
+            number = number*26 + ord(s.upper())-ord('A')+1
+        return number
 
     def _split_range(self,string:str) -> Tuple[int]:
-        '''Translate Excel reference to pandas numbers'''
+        '''Translate Excel reference to first and last column and row numbers'''
         left = string[0:string.index(':')]
         right = string[string.index(':')+1:]
-        letters = []
-        numbers = []
+        columns = []
+        rows = []
         for side in [left,right]:
-            letter = ''.join(s for s in side if not s.isdigit())
-            number = int(''.join(s for s in side if s.isdigit()))
-            letters += [letter]
-            numbers += [number]
-        parse_c = '{}:{}'.format(letters[0],letters[1])
-        skip_r = numbers[0]-1
-        height = numbers[1]-numbers[0]
-        return parse_c,skip_r,height
+            columns += [self._column_number(side)]
+            rows += [int(''.join(s for s in side if s.isdigit()))]
+        return columns[0],rows[0],columns[1],rows[1]
 
     def _name_sheets(self):
         '''Give Excel name to sheets'''
         for table in self.tables:
             sheetnum = self.tables[table]['sheet']
-            self.tables[table]['sheetname'] = sheetnum #self.sheetnames[sheetnum]
\ No newline at end of file
+            self.tables[table]['sheetname'] = self.sheetnames[sheetnum]
\ No newline at end of file